@@ -3,10 +3,12 @@ import datetime
 
 from diversity.task2vec import Task2Vec 
 from diversity import task_similarity
-from diversity.div_coeff import cross_diversity_coefficient
+from diversity.div_coeff import cross_diversity_coefficient, get_task2vec_embeddings
+from diversity.task2vec import ProbeSession
 
 from pathlib import Path
 
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -24,6 +26,7 @@ def alignment_with_diversity_coefficient(dataset_target,
                                         verbose: bool = False,
                                         debug: bool = False,
                                         shuffle: bool = True,  # False for faster debugging/testing but it won't be shuffled
+                                        embedding_store = None,  # diversity.embedding_store.EmbeddingStore to reuse embeddings computed before
                                     ) -> dict:
     """
     Alignment v1 - with the Diversity Coefficient
@@ -34,12 +37,63 @@ def alignment_with_diversity_coefficient(dataset_target,
     
     ref: https://arxiv.org/abs/2306.13840
     """
-    results: dict = cross_diversity_coefficient(dataset_target, dataset_source, map_target, map_source, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size, distance, verbose, debug, shuffle)
+    results: dict = cross_diversity_coefficient(dataset_target, dataset_source, map_target, map_source, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size, distance, verbose, debug, shuffle, embedding_store=embedding_store)
     results['cross_align'] = 1 - results['cross_div_coeff']
     results['cross_align_ci'] = results['cross_div_coeff_ci']
     return results
 
 
+def alignment_matrix(datasets: dict,
+                     maps,  # one map for all data sets, or a dict name -> map
+                     probe_network: nn.Module,
+                     tokenizer = None,
+                     batch_size: int = 512,
+                     num_batches: int = 100,
+                     seed: int = 42,
+                     buffer_size: int = 500_000,
+                     distance = 'cosine',
+                     verbose: bool = False,
+                     debug: bool = False,
+                     shuffle: bool = True,
+                     streaming: bool = True,
+                     prefetch_depth: int = 2,
+                     embedding_store = None,
+                     ) -> dict:
+    """
+    All pairs alignment (v1, with the diversity coefficient) of the named data sets {name: dataset}.
+
+    The num_batches batch embeddings of every data set are computed exactly once (same batches and seeds as
+    cross_diversity_coefficient uses) and then compared for every pair with task_similarity.cross_pdist, i.e., N data
+    sets cost N * num_batches Fisher computations instead of N^2 * 2 * num_batches for every pair separately.
+    Entry [i, j] of the returned matrices is what alignment_with_diversity_coefficient(datasets[i], datasets[j]) gives.
+    """
+    names = list(datasets)
+    probe_session = ProbeSession(probe_network)
+    embeddings, losses = {}, {}
+    for name in names:
+        print(f'-- Embedding {name=}')
+        map = maps[name] if isinstance(maps, dict) else maps
+        embeddings[name], losses[name] = get_task2vec_embeddings(datasets[name], map, probe_network, tokenizer, batch_size, num_batches, seed,
+                                                                 buffer_size, streaming, verbose, debug, shuffle, prefetch_depth, embedding_store,
+                                                                 probe_session=probe_session)
+
+    # - Compute cross diversity coefficient (and alignment) of every pair, the cross distance matrix of (j, i) is the transpose of (i, j)
+    cross_div_coeff, cross_div_coeff_ci = np.zeros([len(names), len(names)]), np.zeros([len(names), len(names)])
+    for i, name_i in enumerate(names):
+        for j in range(i, len(names)):
+            cross_distance_matrix = task_similarity.cross_pdist(embeddings[name_i], embeddings[names[j]], distance=distance)
+            cross_div_coeff[i, j], cross_div_coeff_ci[i, j] = task_similarity.stats_cross_distance_matrix(cross_distance_matrix)
+            cross_div_coeff[j, i], cross_div_coeff_ci[j, i] = cross_div_coeff[i, j], cross_div_coeff_ci[i, j]
+    
+    results: dict = {'names': names,
+                     'cross_div_coeff': cross_div_coeff, 'cross_div_coeff_ci': cross_div_coeff_ci,
+                     'cross_align': 1 - cross_div_coeff, 'cross_align_ci': cross_div_coeff_ci,
+                     'embeddings': embeddings,
+                     'losses': losses,
+                     'num_batches': num_batches}
+    return results
+
+
 def alignment_task2vec(dataset_target,
                         dataset_source,
                         map_target: callable,
@@ -28,6 +28,8 @@ import torch
 from transformers import GPT2LMHeadModel, PreTrainedTokenizer, AutoTokenizer, Trainer, TrainingArguments, AutoConfig
 import math
 
+from diversity.batch_sampling import IndexSampler
+
 
 # -- Experiments 
 
@@ -192,7 +194,7 @@ def train():
     train_dataset = interleave_datasets(train_datasets, probabilities)
     # TODO: suffle data set False, True, note i've experienced that with shuffle_ds.take(512) is slow...
     shuffled_dataset = train_dataset.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else train_dataset
-    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(list(range(len(shuffled_dataset))), batch_size))
+    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(IndexSampler(len(shuffled_dataset), seed=seed).sample(batch_size))
     # print(f'{batch=}')
     # column_names = next(iter(batch)).keys()
     def preprocess(examples):
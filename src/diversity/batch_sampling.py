@@ -0,0 +1,218 @@
+"""
+Samplers for the batches (i.e., tasks) the diversity coefficient is computed over (and prefetching them).
+
+Re-shuffling the data set for every batch refills the shuffle buffer (e.g., buffer_size=500_000) num_batches times and,
+with the same seed, hands out the same batch over and over. Instead we make a single pass over one shuffled stream
+and cut it into num_batches disjoint batches, so the data cost grows with num_batches * batch_size (the examples we
+actually use) and not with buffer_size * num_batches.
+"""
+import queue
+import random
+import threading
+from typing import Iterable, Iterator, Optional
+
+from datasets import Dataset
+
+
+class IndexSampler:
+    """
+    Draws batches of row indices of a map-style data set without replacement in O(batch_size) time and memory.
+
+    random.sample(list(range(len(dataset))), batch_size) builds an O(N) Python list for every batch, which hurts on
+    data sets with hundreds of millions of rows. Within a batch indices are always distinct. With disjoint=True no index
+    is handed out twice across batches either, which costs memory proportional to the number of indices sampled so far
+    (never to the size of the data set). If seed is None the global `random` state is used (e.g., as set by set_seed).
+    """
+
+    def __init__(self, num_rows: int, seed: Optional[int] = None, disjoint: bool = True):
+        self.num_rows = num_rows
+        self.rng = random.Random(seed) if seed is not None else random
+        self.disjoint = disjoint
+        self.used: set[int] = set()
+
+    def sample(self, batch_size: int) -> list[int]:
+        num_available = self.num_rows - len(self.used)
+        if batch_size > num_available:
+            raise ValueError(f'Can not sample {batch_size=} new indices, only {num_available} of {self.num_rows} rows are left.')
+        if not self.disjoint:
+            # note: random.sample on a range uses set based selection i.e., O(batch_size) and it does not materialize the range
+            return self.rng.sample(range(self.num_rows), batch_size)
+        if len(self.used) + batch_size <= self.num_rows // 2:
+            # rejection sampling, since at most half the rows are used each draw succeeds with prob >= 1/2 (expected O(batch_size))
+            indices = []
+            while len(indices) < batch_size:
+                index = self.rng.randrange(self.num_rows)
+                if index not in self.used:
+                    self.used.add(index)
+                    indices.append(index)
+        else:
+            # most of the data set is already used, so it's cheaper to sample directly from the rows that are left
+            remaining = [index for index in range(self.num_rows) if index not in self.used]
+            indices = self.rng.sample(remaining, batch_size)
+            self.used.update(indices)
+        return indices
+
+
+def get_batch_seed(seed: int, batch_num: int) -> int:
+    """ Deterministic seed of a batch (e.g., for fine-tuning the probe network on it), same convention as main.py. """
+    return seed + batch_num
+
+
+def iter_disjoint_batches(dataset,
+                          batch_size: int,
+                          num_batches: int,
+                          seed: int = 42,
+                          buffer_size: int = 500_000,
+                          shuffle: bool = True,
+                          streaming: bool = True,
+                          ) -> Iterator[tuple[int, int, Dataset]]:
+    """
+    Yields (batch_num, batch_seed, batch) for num_batches disjoint batches of batch_size examples.
+
+    Streaming data sets are shuffled once (if shuffle) and read in a single pass, every batch_size consecutive examples
+    of the stream being one batch. Map-style data sets are sampled without replacement with random access (seeded by
+    seed, see IndexSampler). Batches are returned as (in memory) map-style HF data sets so the usual `map(batch)`
+    tokenization works on them.
+    """
+    if streaming:
+        shuffled_dataset = dataset.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset
+        batch_num, examples = 0, []
+        if num_batches <= 0:
+            return
+        for example in shuffled_dataset:
+            examples.append(example)
+            if len(examples) == batch_size:
+                yield batch_num, get_batch_seed(seed, batch_num), Dataset.from_list(examples).with_format("torch")
+                batch_num, examples = batch_num + 1, []
+                if batch_num == num_batches:
+                    return
+        raise ValueError(f'Data set ran out after {batch_num} batches, but {num_batches=} of {batch_size=} were requested.')
+    else:
+        if num_batches * batch_size > len(dataset):
+            raise ValueError(f'Can not sample {num_batches=} disjoint batches of {batch_size=} from {len(dataset)=} examples.')
+        index_sampler = IndexSampler(len(dataset), seed=seed, disjoint=True)
+        for batch_num in range(num_batches):
+            yield batch_num, get_batch_seed(seed, batch_num), dataset.select(index_sampler.sample(batch_size))
+
+
+class _PrefetchError:
+    """ Wraps an exception raised by the producer thread so the consumer can re-raise it. """
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_END = object()
+
+
+def prefetch(iterable: Iterable, depth: int = 2) -> Iterator:
+    """
+    Iterates iterable in a background thread, at most depth items ahead of the consumer, e.g., fetching and tokenizing
+    batch k+1 (HF streaming reads and fast tokenizers release the GIL) while batch k is in Task2Vec.embed.
+
+    Memory is bounded by the depth items in the queue (plus the one being produced). An exception in the producer is
+    re-raised in the consumer at the point its item would have been, and closing the generator early (e.g., break or
+    an exception in the consumer) stops the producer after its current item. depth <= 0 means no prefetching.
+    """
+    if depth <= 0:
+        yield from iterable
+        return
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as error:
+            put(_PrefetchError(error))
+            return
+        put(_END)
+
+    producer = threading.Thread(target=produce, name='prefetch', daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _END:
+                return
+            if isinstance(item, _PrefetchError):
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        producer.join()
+
+# -- Tests, examples
+
+def test_index_sampler():
+    sampler = IndexSampler(10**9, seed=0)
+    indices = [index for _ in range(10) for index in sampler.sample(512)]
+    assert len(set(indices)) == len(indices) == 5120 and all(0 <= index < 10**9 for index in indices)
+    assert indices[:512] == IndexSampler(10**9, seed=0).sample(512), 'Err: sampler is not deterministic given a seed'
+    # small data sets get used up completely and then complain
+    sampler = IndexSampler(10, seed=0)
+    assert sorted(sampler.sample(4) + sampler.sample(4) + sampler.sample(2)) == list(range(10))
+    try:
+        sampler.sample(1)
+        raise AssertionError('Err: sampler should have run out of rows')
+    except ValueError:
+        pass
+    print('Success!')
+
+def test_iter_disjoint_batches():
+    data = Dataset.from_dict({'text': [str(i) for i in range(100)]})
+    for streaming in [True, False]:
+        dataset = data.to_iterable_dataset() if streaming else data
+        batches = list(iter_disjoint_batches(dataset, batch_size=8, num_batches=10, seed=0, buffer_size=50, streaming=streaming))
+        texts = [text for _, _, batch in batches for text in batch['text']]
+        assert len(texts) == 80 and len(set(texts)) == 80, f'Err: batches are not disjoint {streaming=}'
+        assert [batch_seed for _, batch_seed, _ in batches] == list(range(10))
+        again = [text for _, _, batch in iter_disjoint_batches(dataset, batch_size=8, num_batches=10, seed=0, buffer_size=50, streaming=streaming) for text in batch['text']]
+        assert texts == again, f'Err: sampling is not deterministic {streaming=}'
+    print('Success!')
+
+def test_prefetch():
+    import time
+    assert list(prefetch(range(100), depth=3)) == list(range(100))
+    assert list(prefetch(range(10), depth=0)) == list(range(10))
+    # errors of the producer reach the consumer after the items before them
+    def failing():
+        yield from range(3)
+        raise RuntimeError('producer failed')
+    seen = []
+    try:
+        for item in prefetch(failing(), depth=2):
+            seen.append(item)
+        raise AssertionError('Err: producer error was swallowed')
+    except RuntimeError:
+        assert seen == [0, 1, 2]
+    # producer runs ahead while the consumer works, but never more than depth items (+1 in flight)
+    produced = []
+    def slow_source():
+        for i in range(6):
+            produced.append(i)
+            yield i
+    start = time.time()
+    for item in prefetch(slow_source(), depth=2):
+        time.sleep(0.05)
+        assert len(produced) - item <= 4, f'Err: prefetch is not bounded {produced=} {item=}'
+        if item == 2:
+            break  # closing early stops the producer
+    assert time.time() - start < 5
+    print('Success!')
+
+if __name__ == '__main__':
+    test_index_sampler()
+    test_iter_disjoint_batches()
+    test_prefetch()
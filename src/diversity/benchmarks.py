@@ -0,0 +1,287 @@
+"""
+Offline benchmarks of the hot paths of the diversity pipeline, to catch regressions and measure optimizations.
+
+Nothing is downloaded: the probe network is a randomly initialized tiny GPT-2 (GPT2Config with the GPT-2 vocab, so the
+lm_head is as big as the real one) and the batches are synthetic upper bound sequences (lower_upper_div_bounds.gen_ub_seq,
+uniformly random tokens). Embeddings for the distances are random positive vectors of the size of the tiny probe's ones.
+
+    python -m diversity.benchmarks --save baseline.json        # run and save the timings (+ versions/machine)
+    python -m diversity.benchmarks --compare baseline.json     # run and compare with them (exit code 1 if slower)
+    python -m diversity.benchmarks --only pdist --quick        # subset (name prefix), smaller sizes
+
+Timings are the median (and min) of repeats after a warm up run, with torch.set_num_threads(threads). Baselines are
+only comparable on the same machine (and threads), so they aren't part of the repo. GINC sampling needs hmmlearn (and
+joblib, see ginc/conda-env.yml), without it that benchmark is skipped.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+from typing import Callable
+
+import numpy as np
+import torch
+
+_BENCHMARKS = {}
+
+
+def _register_benchmark(fn):
+    _BENCHMARKS[fn.__name__[len('bench_'):]] = fn
+    return fn
+
+
+class SkipBenchmark(Exception):
+    """ Raised by a benchmark that can't run here (e.g., an optional dependency is missing). """
+
+
+class _SyntheticVocab:
+    """ What gen_lb_seq/gen_ub_seq need of a tokenizer: the GPT-2 vocab size and eos (= pad) token. """
+    eos_token_id = 50256
+    pad_token_id = 50256
+
+    def __len__(self):
+        return 50257
+
+
+def tiny_probe_network(seed: int = 0, n_embd: int = 64, n_layer: int = 2, max_length: int = 128):
+    """ Randomly initialized (seeded) tiny GPT-2 probe network. """
+    from transformers import GPT2Config, GPT2LMHeadModel
+    torch.manual_seed(seed)
+    return GPT2LMHeadModel(GPT2Config(n_positions=max_length, n_embd=n_embd, n_layer=n_layer, n_head=2))
+
+
+def synthetic_batch(num_sequences: int = 16, max_length: int = 128, seed: int = 0):
+    """ MaterializedBatch of upper bound diversity sequences (gen_ub_seq), padding masked out. """
+    from diversity.lower_upper_div_bounds import gen_ub_seq
+    from diversity.task2vec import MaterializedBatch
+    random.seed(seed)
+    input_ids = torch.stack([gen_ub_seq(_SyntheticVocab(), max_length=max_length) for _ in range(num_sequences)])
+    attention_mask = input_ids != _SyntheticVocab.pad_token_id
+    return MaterializedBatch(input_ids, attention_mask)
+
+
+def synthetic_embeddings(num_embeddings: int, dim: int, seed: int = 0) -> list:
+    """ Random autoregressive-like embeddings (positive float32 hessians, scale of ones). """
+    from diversity.task2vec import Embedding
+    rng = np.random.default_rng(seed)
+    return [Embedding(hessian=rng.gamma(0.5, size=dim).astype(np.float32), scale=None) for _ in range(num_embeddings)]
+
+
+def time_fn(fn: Callable, repeats: int = 5, warmup: int = 1, setup: Callable = None) -> list[float]:
+    """ Wall times of repeats calls of fn (after warmup calls), setup (untimed) runs before every call. """
+    times = []
+    for k in range(warmup + repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        fn()
+        if k >= warmup:
+            times.append(time.perf_counter() - start)
+    return times
+
+# -- Benchmarks: each takes (repeats, quick) and returns {'times': [...], 'params': {...}} or a dict of them
+
+def _task2vec_setup(quick: bool):
+    from diversity.task2vec import ProbeSession, Task2Vec
+    params = {'num_sequences': 8 if quick else 32, 'max_length': 64 if quick else 128, 'n_embd': 64, 'n_layer': 2, 'epochs': 1}
+    session = ProbeSession(tiny_probe_network(n_embd=params['n_embd'], n_layer=params['n_layer'], max_length=params['max_length']))
+    batch = synthetic_batch(params['num_sequences'], params['max_length'])
+    task2vec = Task2Vec(session.model, _deep_copy=False, classifier_opts={'seed': 0})
+    task2vec.fisher_accumulator = session.fisher_accumulator
+    return session, task2vec, batch, params
+
+
+@_register_benchmark
+def bench_task2vec(repeats: int, quick: bool) -> dict:
+    """ Task2Vec.embed (fine-tuning + Monte Carlo Fisher + extract) and its fine-tuning and Fisher stages alone. """
+    session, task2vec, batch, params = _task2vec_setup(quick)
+    finetune = lambda: task2vec._finetune_classifier(batch, classifier_opts={'seed': 0}, epochs=params['epochs'])
+    fisher = lambda: task2vec.compute_fisher(batch)
+    embed = lambda: session.embed(batch, epochs=params['epochs'], classifier_opts={'seed': 0})
+    return {'task2vec_embed': {'times': time_fn(embed, repeats, setup=session.restore), 'params': params},
+            'task2vec_finetune': {'times': time_fn(finetune, repeats, setup=session.restore), 'params': params},
+            'task2vec_fisher': {'times': time_fn(fisher, repeats, setup=session.restore), 'params': params}}
+
+
+@_register_benchmark
+def bench_pdist(repeats: int, quick: bool) -> dict:
+    """ task_similarity.pdist (condensed) for every distance with a vectorized kernel. """
+    from diversity import task_similarity
+    from diversity.sketching import sketch_embedding
+    params = {'num_embeddings': 50 if quick else 200, 'dim': 20_000 if quick else 100_000}
+    embeddings = synthetic_embeddings(params['num_embeddings'], params['dim'])
+    for embedding in embeddings:
+        sketch_embedding(embedding, dim=1024)
+    results = {}
+    for distance in task_similarity._PAIRWISE_DISTANCES:
+        condensed = distance != 'asymmetric_kl'
+        pdist = lambda: task_similarity.pdist(embeddings, distance=distance, condensed=condensed)
+        results[f'pdist_{distance}'] = {'times': time_fn(pdist, repeats), 'params': {**params, 'distance': distance}}
+    return results
+
+
+@_register_benchmark
+def bench_stats_of_distance_matrix(repeats: int, quick: bool) -> dict:
+    """ Mean/std and mean/bootstrap ci of the distances of an [n, n] distance matrix. """
+    from diversity import task_similarity
+    params = {'num_embeddings': 200 if quick else 600}
+    rng = np.random.default_rng(0)
+    distance_matrix = task_similarity.squareform(rng.random(params['num_embeddings'] * (params['num_embeddings'] - 1) // 2))
+    results = {}
+    for variance_type in ('std', 'ci_0.95'):
+        stats = lambda: task_similarity.stats_of_distance_matrix(distance_matrix, variance_type=variance_type)
+        results[f'stats_of_distance_matrix_{variance_type}'] = {'times': time_fn(stats, repeats), 'params': {**params, 'variance_type': variance_type}}
+    return results
+
+
+@_register_benchmark
+def bench_group_texts(repeats: int, quick: bool) -> dict:
+    """ training.utils.group_texts on a batched map's worth of tokenized (unpadded) sequences. """
+    from training.utils import group_texts
+    params = {'num_sequences': 200 if quick else 1000, 'max_length': 128, 'block_size': 1024}
+    batch = synthetic_batch(params['num_sequences'], params['max_length'])
+    lengths = batch.attention_mask.sum(dim=1).tolist()
+    examples = {'input_ids': [ids[:n] for ids, n in zip(batch.input_ids.tolist(), lengths)],
+                'attention_mask': [[1] * n for n in lengths]}
+    group = lambda: group_texts(examples, block_size=params['block_size'])
+    return {'group_texts': {'times': time_fn(group, repeats), 'params': params}}
+
+
+@_register_benchmark
+def bench_ginc_sampling(repeats: int, quick: bool) -> dict:
+    """ Sampling GINC pretraining documents from a mixture of HMMs (ginc/generate_data.py with its default sizes). """
+    try:
+        from hmmlearn.hmm import MultinomialHMM
+        import ginc.generate_data as generate_data
+    except ImportError as e:
+        raise SkipBenchmark(f'GINC sampling needs the ginc requirements: {e}')
+    params = {'n_hmms': 4 if quick else 10, 'n_symbols': 50, 'n_values': 10, 'n_slots': 10, 'num_samples': 4 if quick else 20,
+              'sample_length': 1024 if quick else 10240}
+    # generate_hmm_parameters reads the script's args
+    generate_data.args = argparse.Namespace(prior_values=False)
+    np.random.seed(0)
+    generate_data.vocab = np.asarray(['/'] + list(generate_data.letter_generator(params['n_symbols']))[:-1])
+    n_components = params['n_values'] * params['n_slots']
+    all_values = np.random.randint(low=1, high=params['n_symbols'], size=(params['n_values'], params['n_slots']))
+    all_values[:, 0] = 0
+    hmms = []
+    for _ in range(params['n_hmms']):
+        startprob, transmat, emissionprob, _, _ = generate_data.generate_hmm_parameters(
+            params['n_values'], params['n_slots'], params['n_symbols'], all_values, perm_samples=n_components,
+            transition_temp=0.1, start_temp=10.0)
+        hmm = MultinomialHMM(n_components=n_components)
+        hmm.startprob_, hmm.transmat_, hmm.emissionprob_ = startprob, transmat, emissionprob
+        hmms.append(hmm)
+    sample = lambda: generate_data.generate_samples(params['num_samples'], hmms, params['sample_length'])
+    return {'ginc_sampling': {'times': time_fn(sample, repeats), 'params': params}}
+
+# -- Running, saving and comparing
+
+def environment() -> dict:
+    import transformers
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'torch': torch.__version__, 'numpy': np.__version__, 'transformers': transformers.__version__,
+            'torch_threads': torch.get_num_threads()}
+
+
+def run_benchmarks(only: list[str] = None, repeats: int = 5, quick: bool = False) -> dict:
+    """ {'environment': ..., 'results': {name: {median_s, min_s, times, params}}, 'skipped': {benchmark: reason}}. """
+    results, skipped = {}, {}
+    for name, bench in _BENCHMARKS.items():
+        if only and not any(name.startswith(prefix) or prefix.startswith(name) for prefix in only):
+            continue
+        print(f'--> {name=}')
+        try:
+            timings = bench(repeats, quick)
+        except SkipBenchmark as e:
+            print(f'Skipping {name}: {e}')
+            skipped[name] = str(e)
+            continue
+        for result_name, result in timings.items():
+            if only and not any(result_name.startswith(prefix) for prefix in only):
+                continue
+            results[result_name] = {'median_s': statistics.median(result['times']), 'min_s': min(result['times']), **result}
+            print(f'{result_name:<40} median={results[result_name]["median_s"]:.4g}s min={results[result_name]["min_s"]:.4g}s')
+    return {'environment': environment(), 'quick': quick, 'repeats': repeats, 'results': results, 'skipped': skipped}
+
+
+def compare(baseline: dict, current: dict, tolerance: float = 0.1) -> dict:
+    """
+    Ratio current / baseline of the median time of every benchmark both have, it's a regression if it's above
+    1 + tolerance (and an improvement below 1 - tolerance). Benchmarks with different params aren't compared.
+    """
+    comparison = {}
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or base['params'] != result['params']:
+            continue
+        ratio = result['median_s'] / max(base['median_s'], 1e-12)
+        status = 'regression' if ratio > 1 + tolerance else 'improvement' if ratio < 1 - tolerance else 'same'
+        comparison[name] = {'baseline_s': base['median_s'], 'current_s': result['median_s'], 'ratio': ratio, 'status': status}
+    return comparison
+
+
+def print_comparison(comparison: dict):
+    print(f'{"benchmark":<40}{"baseline_s":>14}{"current_s":>14}{"ratio":>10}  status')
+    for name, c in comparison.items():
+        print(f'{name:<40}{c["baseline_s"]:>14.4g}{c["current_s"]:>14.4g}{c["ratio"]:>10.3f}  {c["status"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the diversity pipeline (see diversity.benchmarks).')
+    parser.add_argument('--only', nargs='*', default=None, help=f'Benchmarks to run (name prefixes), of: {list(_BENCHMARKS)}')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed runs per benchmark (after a warm up run).')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads for the run (default: torch\'s).')
+    parser.add_argument('--quick', action='store_true', help='Smaller sizes (e.g., to check the benchmarks run).')
+    parser.add_argument('--save', type=str, default=None, help='Save the timings to this json file (e.g., as a baseline).')
+    parser.add_argument('--compare', type=str, default=None, help='Compare the timings with the ones saved in this json file.')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='Relative slowdown that counts as a regression.')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    current = run_benchmarks(args.only, repeats=args.repeats, quick=args.quick)
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump(current, f, indent=2)
+        print(f'Saved timings to {args.save=}')
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['environment'].get('torch_threads') != current['environment']['torch_threads']:
+            print(f'Warning: baseline ran with {baseline["environment"].get("torch_threads")} threads, this run with {current["environment"]["torch_threads"]}')
+        comparison = compare(baseline, current, tolerance=args.tolerance)
+        print_comparison(comparison)
+        if any(c['status'] == 'regression' for c in comparison.values()):
+            sys.exit(1)
+
+# -- Tests, examples
+
+def test_benchmarks():
+    import tempfile
+    current = run_benchmarks(['pdist_cosine', 'stats_of_distance_matrix', 'group_texts'], repeats=1, quick=True)
+    assert 'pdist_cosine' in current['results'] and 'pdist_kl' not in current['results']
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'baseline.json')
+        with open(path, 'w') as f:
+            json.dump(current, f)
+        with open(path) as f:
+            baseline = json.load(f)
+    slower = json.loads(json.dumps(current))
+    slower['results']['group_texts']['median_s'] *= 2
+    comparison = compare(baseline, slower)
+    print_comparison(comparison)
+    assert comparison['group_texts']['status'] == 'regression' and comparison['pdist_cosine']['status'] == 'same'
+    print('Success!')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_benchmarks()
@@ -5,6 +5,7 @@ GPT4 suggested this: https://chat.openai.com/share/495de296-71c2-4f5e-83e2-3b22d
 It also would have made all the data set interfaces consistent in training vs computing data set metrics.
 """
 import time
+from collections import deque
 
 from pathlib import Path
 import datetime
@@ -12,14 +13,207 @@ import json
 
 from torch import nn
 import numpy as np
-import random
 
 from datasets import load_dataset
 from datasets import interleave_datasets
 
-from diversity.task2vec import Task2Vec
+from diversity.task2vec import ProbeSession, materialize_batch
 import diversity.task_similarity as task_similarity
+from diversity.batch_sampling import iter_disjoint_batches, prefetch
+from diversity.embedding_store import EmbeddingStore, batch_hash, embedding_key, dataset_id, tokenizer_id, probe_network_hash
+from diversity.profiling import stage, traced
 
+def tokenized_batches(batches, map: callable, prefetch_depth: int = 2):
+    """
+    Yields (batch_num, batch_seed, tokenized batch) for the (batch_num, batch_seed, batch) of batches. Fetching,
+    tokenizing (map) and materializing happen prefetch_depth batches ahead in a background thread, so they overlap with
+    ProbeSession.embed of the current batch (prefetch_depth=0 does it in sequence).
+    """
+    return prefetch(_tokenized_batches(batches, map), depth=prefetch_depth)
+
+def _tokenized_batches(batches, map: callable):
+    batches = iter(batches)
+    while True:
+        # - fetch (I/O, e.g., streaming + shuffle buffer) and tokenize separately, so a trace tells them apart
+        with stage('fetch_batch') as fetch:
+            item = next(batches, None)
+            if item is not None:
+                fetch.add(examples=len(item[2]))
+        if item is None:
+            return
+        batch_num, batch_seed, batch = item
+        with stage('tokenize_batch', batch_num=batch_num) as tokenize:
+            tokenized = materialize_batch(map(batch))
+            tokenize.add(examples=len(tokenized), tokens=int(tokenized.attention_mask.sum()))
+        yield batch_num, batch_seed, tokenized
+
+def task2vec_opts(batch_seed: int, debug: bool = False) -> dict:
+    """ Options (ProbeSession.embed kwargs) the Task2Vec embedding of a batch is computed with. """
+    if not debug:
+        return {'classifier_opts': {'seed': batch_seed}, 'epochs': 5}
+    else:
+        return {'classifier_opts': {'break_early': True, 'seed': batch_seed}, 'epochs': 1}  # only for debugging
+
+def _embedding_store_key(batch, probe_hash: str, embed_kwargs: dict, layer_opts: dict = None, sketch_opts: dict = None) -> str:
+    sketch_opts = {'sketch_opts': sketch_opts} if sketch_opts else {}  # (keeps older keys valid)
+    return embedding_key(batch=batch_hash(batch), probe_network=probe_hash, classifier_opts=embed_kwargs['classifier_opts'],
+                         epochs=embed_kwargs['epochs'], layer_opts=layer_opts, **sketch_opts)
+
+def get_task2vec_embedding(probe_session: ProbeSession,
+                           batch,
+                           batch_seed: int,
+                           debug: bool = False,
+                           embedding_store: EmbeddingStore = None,
+                           probe_hash: str = None,
+                           **info,
+                           ):
+    """
+    (embedding, loss) of ProbeSession.embed on a tokenized (materialized) batch. With an embedding_store it's looked up there first
+    (keyed by the batch content, the probe network weights probe_hash and the Task2Vec options) and stored after
+    computing it, info (e.g., data set, batch_seed) is saved along with it.
+    """
+    embed_kwargs = task2vec_opts(batch_seed, debug)
+    if embedding_store is None:
+        return probe_session.embed(batch, **embed_kwargs)
+    key = _embedding_store_key(batch, probe_hash, embed_kwargs, probe_session.layer_opts, probe_session.sketch_opts)
+    stored = embedding_store.get(key)
+    if stored is not None:
+        print(f'Using stored embedding {key=}')
+        return stored
+    embedding, loss = probe_session.embed(batch, **embed_kwargs)
+    embedding_store.put(key, embedding, loss, batch_seed=batch_seed, batch_size=len(batch), seq_len=batch.input_ids.shape[1], **info)
+    return embedding, loss
+
+def iter_task2vec_embeddings(dataset,
+                             map: callable,
+                             probe_network: nn.Module,
+                             tokenizer = None,
+                             batch_size: int = 512,
+                             num_batches: int = 600,
+                             seed: int = 42,
+                             buffer_size: int = 500_000,
+                             streaming: bool = True,
+                             verbose: bool = False,
+                             debug: bool = False,
+                             shuffle: bool = True,
+                             prefetch_depth: int = 2,
+                             embedding_store: EmbeddingStore = None,
+                             probe_session: ProbeSession = None,
+                             num_workers: int = 1,
+                             threads_per_worker: int = 1,
+                             sketch_opts: dict = None,
+                             ):
+    """
+    Yields (batch_num, embedding, loss) of num_batches disjoint batches of dataset as they are embedded, see
+    get_diversity_coefficient. Stopping early (e.g., break) stops fetching batches. With num_workers > 1 the batches are
+    embedded by that many worker processes with threads_per_worker torch threads each (see diversity.parallel_embedding),
+    in the same order. The embeddings don't depend on num_workers but do (slightly, the order of float reductions) on
+    threads_per_worker, i.e., they equal the in-process ones when threads_per_worker is this process' torch threads.
+    Without a probe_session one is created (with sketch_opts) in this process, or in every worker with num_workers > 1.
+    """
+    if num_workers > 1:
+        yield from _iter_task2vec_embeddings_parallel(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed,
+                                                      buffer_size, streaming, verbose, debug, shuffle, prefetch_depth,
+                                                      embedding_store, probe_session, num_workers, threads_per_worker,
+                                                      sketch_opts)
+        return
+    # reuse the probe network across batches (restoring its lm_head after each batch) instead of deep copying it
+    probe_session = ProbeSession(probe_network, sketch_opts=sketch_opts) if probe_session is None else probe_session
+    probe_hash = probe_network_hash(probe_network) if embedding_store is not None else None
+    info = {**dataset_id(dataset), 'tokenizer': tokenizer_id(tokenizer)}
+    # single pass over one shuffled stream that hands out num_batches disjoint batches
+    batches = iter_disjoint_batches(dataset, batch_size, num_batches, seed=seed, buffer_size=buffer_size, shuffle=shuffle, streaming=streaming)
+    # - Get (tokenized) batch, prepared in the background while the previous one is being embedded
+    for batch_num, batch_seed, batch in tokenized_batches(batches, map, prefetch_depth=prefetch_depth):
+        print(f'--> {batch_num=}\n')
+        if verbose:
+            print(f'{batch=}')
+
+        # - Get Task2Vec embedding for batch
+        embedding, loss = get_task2vec_embedding(probe_session, batch, batch_seed, debug=debug, embedding_store=embedding_store,
+                                                 probe_hash=probe_hash, batch_num=batch_num, **info)
+        print(f'{loss=}\n{embedding=}\n') if verbose else None
+        yield batch_num, embedding, loss
+
+## LLM DIV
+class _Stored:
+    """ Embedding found in the embedding store, queued with the ones the workers compute so results stay in order. """
+
+    def __init__(self, result):
+        self.result = result
+
+    def get(self):
+        return self.result
+
+def _iter_task2vec_embeddings_parallel(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size,
+                                       streaming, verbose, debug, shuffle, prefetch_depth, embedding_store, probe_session,
+                                       num_workers, threads_per_worker, sketch_opts):
+    """ iter_task2vec_embeddings with num_workers processes, the embedding store is only read/written by this process. """
+    from diversity.parallel_embedding import EmbeddingPool
+    layer_opts = probe_session.layer_opts if probe_session is not None else None
+    sketch_opts = probe_session.sketch_opts if probe_session is not None else sketch_opts
+    probe_hash = probe_network_hash(probe_network) if embedding_store is not None else None
+    info = {**dataset_id(dataset), 'tokenizer': tokenizer_id(tokenizer)}
+    batches = iter_disjoint_batches(dataset, batch_size, num_batches, seed=seed, buffer_size=buffer_size, shuffle=shuffle, streaming=streaming)
+    with EmbeddingPool(probe_network, num_workers, threads_per_worker=threads_per_worker, layer_opts=layer_opts,
+                       sketch_opts=sketch_opts) as pool:
+        pending = deque()
+
+        def finish():
+            # - Wait for the oldest batch (results come out in batch order), store it if it was computed
+            batch_num, batch_seed, key, batch_info, result = pending.popleft()
+            embedding, loss = result.get()
+            if key is not None and not isinstance(result, _Stored):
+                embedding_store.put(key, embedding, loss, batch_seed=batch_seed, batch_num=batch_num, **batch_info, **info)
+            print(f'--> {batch_num=}\n{loss=}\n')
+            print(f'{embedding=}\n') if verbose else None
+            return batch_num, embedding, loss
+
+        # - Submit (tokenized) batches to the workers, at most max_in_flight ahead of the results
+        for batch_num, batch_seed, batch in tokenized_batches(batches, map, prefetch_depth=prefetch_depth):
+            embed_kwargs = task2vec_opts(batch_seed, debug)
+            key, stored = None, None
+            if embedding_store is not None:
+                key = _embedding_store_key(batch, probe_hash, embed_kwargs, layer_opts, sketch_opts)
+                stored = embedding_store.get(key)
+            result = _Stored(stored) if stored is not None else pool.submit(batch, embed_kwargs)
+            pending.append((batch_num, batch_seed, key, {'batch_size': len(batch), 'seq_len': batch.input_ids.shape[1]}, result))
+            if len(pending) >= pool.max_in_flight:
+                yield finish()
+        while pending:
+            yield finish()
+
+def get_task2vec_embeddings(dataset,
+                            map: callable,
+                            probe_network: nn.Module,
+                            tokenizer = None,
+                            batch_size: int = 512,
+                            num_batches: int = 600,
+                            seed: int = 42,
+                            buffer_size: int = 500_000,
+                            streaming: bool = True,
+                            verbose: bool = False,
+                            debug: bool = False,
+                            shuffle: bool = True,
+                            prefetch_depth: int = 2,
+                            embedding_store: EmbeddingStore = None,
+                            probe_session: ProbeSession = None,
+                            num_workers: int = 1,
+                            threads_per_worker: int = 1,
+                            sketch_opts: dict = None,
+                            ) -> tuple[list, list]:
+    """ Task2Vec embeddings (and fine-tuning losses) of num_batches disjoint batches of dataset, see get_diversity_coefficient. """
+    embeddings, losses = [], []
+    for _, embedding, loss in iter_task2vec_embeddings(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed,
+                                                       buffer_size, streaming, verbose, debug, shuffle, prefetch_depth,
+                                                       embedding_store, probe_session, num_workers, threads_per_worker,
+                                                       sketch_opts):
+        # - Collect results
+        embeddings.append(embedding)
+        losses.append(loss)
+    return embeddings, losses
+
+@traced('get_diversity_coefficient')
 def get_diversity_coefficient(dataset,
                             map: callable,  # to ease whatever ars you want to batch.map for any data set
                             probe_network: nn.Module,
@@ -33,50 +227,42 @@ def get_diversity_coefficient(dataset,
                             verbose: bool = False,
                             debug: bool = False,
                             shuffle: bool = True,  # False for faster debugging/testing but it won't be shuffled
+                            prefetch_depth: int = 2,  # batches fetched & tokenized ahead in the background, 0 for none
+                            embedding_store: EmbeddingStore = None,  # reuse embeddings computed before (and store the new ones)
+                            condensed_distances: bool = False,  # results['distance_matrix'] in condensed form (pairs i < j), half the memory
+                            ci_target: float = None,  # online mode: stop once the ci (half width) of the div coeff is below it
+                            min_batches: int = 10,  # online mode: never stop before this many batches
+                            max_seconds: float = None,  # online mode: also stop after this much time
+                            sketch_opts: dict = None,  # e.g., {'dim': 4096} also computes sketches of the embeddings (for distance='sketch_cosine')
+                            num_workers: int = 1,  # > 1 embeds batches in that many cpu worker processes (same results)
+                            threads_per_worker: int = 1,  # torch threads of each worker, the embeddings depend on it (not on num_workers)
                           ) -> dict:
     """
     Compute the diversity coefficient of a dataset using a probe network.
     Return all results in a dictionary since it's often useful to store them to avoid recomputing them.
     If you want the diveristy coefficient and it's confidence interval (ci), use the following:
         div_coeff, div_coeff_ci = results['div_coeff'], results['div_coeff_ci']
+
+    With ci_target (or max_seconds) the diversity coefficient is computed online: every new embedding is compared with
+    the previous ones as it arrives and embedding stops once the (jackknife) ci of the div coeff is below ci_target
+    (after at least min_batches), or max_seconds passed, or num_batches (the budget) are used. The ci is in
+    results['div_coeff_ci_half_width'] and results['num_batches'] is the number of batches actually used.
     """
     print(f'{shuffle=}')
     if num_batches < 3:
         print(f'Warning: num_batches must be >= 3, but got {num_batches=} otherwise you only get 1 comparison so 1 distance value')
-    # - Compute embeddings
-    embeddings, losses = [], []
-    for batch_num in range(num_batches):
-        print(f'--> {batch_num=}\n')
-        # - Get batch
-        shuffled_dataset = dataset.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset
-        # raw_text_batch = shuffled_dataset.take(batch_size)
-        # raw_text_batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(range(batch_size))
-        # raw_text_batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(batch_size, batch_size))
-        # tokenized_batch = map(raw_text_batch)
-        batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(list(range(len(shuffled_dataset))), batch_size))
-        batch = map(batch)
-        if verbose:
-            # print(f'{raw_text_batch=}')
-            # print(f'{tokenized_batch=}')
-            print(f'{batch=}')
-            # time_start = time.time()
-            # print(f'{next(iter(raw_text_batch))=}')
-            # print(f'{next(iter(tokenized_batch))=}')
-            # print(f'Time it took: {time.time() - time_start} seconds \a\n')
-
-        # - Get Task2Vec embedding for batch
-        if not debug:
-            embedding, loss = Task2Vec(probe_network, classifier_opts={'seed': seed}).embed(batch)
-        else:
-            embedding, loss = Task2Vec(probe_network, classifier_opts={'break_early': True, 'seed': seed}).embed(batch, epochs=1)  # only for debugging
-        print(f'{loss=}\n{embedding=}\n') if verbose else None
-        
-        # - Collect results
-        embeddings.append(embedding)
-        losses.append(loss)
+    if ci_target is not None or max_seconds is not None:
+        return _online_diversity_coefficient(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size,
+                                             streaming, distance, verbose, debug, shuffle, prefetch_depth, embedding_store,
+                                             condensed_distances, ci_target, min_batches, max_seconds, sketch_opts, num_workers,
+                                             threads_per_worker)
+    # - Compute embeddings (the probe session is created in this process or in the workers)
+    embeddings, losses = get_task2vec_embeddings(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size,
+                                                 streaming, verbose, debug, shuffle, prefetch_depth, embedding_store, None,
+                                                 num_workers, threads_per_worker, sketch_opts)
         
     # - Compute diversity coefficient
-    distance_matrix = task_similarity.pdist(embeddings, distance=distance)
+    distance_matrix = task_similarity.pdist(embeddings, distance=distance, condensed=condensed_distances)
     div_coeff, div_coeff_ci = task_similarity.stats_of_distance_matrix(distance_matrix)
 
     # -- Return results
@@ -87,6 +273,46 @@ def get_diversity_coefficient(dataset,
                     "num_batches": num_batches}
     return results
 
+## LLM DIV
+def _online_diversity_coefficient(dataset, map, probe_network, tokenizer, batch_size, num_batches, seed, buffer_size,
+                                  streaming, distance, verbose, debug, shuffle, prefetch_depth, embedding_store,
+                                  condensed_distances, ci_target, min_batches, max_seconds, sketch_opts, num_workers,
+                                  threads_per_worker) -> dict:
+    """ Online (sequential early stopping) mode of get_diversity_coefficient. """
+    stats = task_similarity.OnlineDistanceStats(distance=distance)
+    losses, trace = [], []
+    converged = False
+    start = time.time()
+    for batch_num, embedding, loss in iter_task2vec_embeddings(dataset, map, probe_network, tokenizer, batch_size, num_batches,
+                                                               seed, buffer_size, streaming, verbose, debug, shuffle,
+                                                               prefetch_depth, embedding_store, None, num_workers,
+                                                               threads_per_worker, sketch_opts):
+        # - Compare the new embedding with the previous ones and report the current div coeff
+        stats.add(embedding)
+        losses.append(loss)
+        trace.append({'num_batches': len(stats), 'div_coeff': stats.mean, 'div_coeff_ci_half_width': stats.ci,
+                      'seconds': time.time() - start})
+        print(f'Online div coeff: num_batches={len(stats)} div_coeff={stats.mean} ci_half_width={stats.ci}')
+        # - Stop once the ci is small enough or the budget is used
+        if ci_target is not None and len(stats) >= min_batches and stats.ci <= ci_target:
+            converged = True
+            break
+        if max_seconds is not None and time.time() - start >= max_seconds:
+            break
+
+    # -- Return results (the same stats as the batch mode on the embeddings used)
+    distance_matrix = stats.distance_matrix(condensed=condensed_distances)
+    div_coeff, div_coeff_ci = task_similarity.stats_of_distance_matrix(distance_matrix)
+    results : dict = {'div_coeff': div_coeff, 'div_coeff_ci': div_coeff_ci,
+                      'div_coeff_ci_half_width': stats.ci,
+                      'embeddings': stats.embeddings,
+                      'distance_matrix': distance_matrix,
+                      'losses': losses,
+                      "num_batches": len(stats),
+                      'converged': converged,
+                      'online_trace': trace}
+    return results
+
 def cross_diversity_coefficient(dataset_target,
                                 dataset_source,
                                 map_target: callable, 
@@ -101,35 +327,41 @@ def cross_diversity_coefficient(dataset_target,
                                 verbose: bool = False,
                                 debug: bool = False,
                                 shuffle: bool = True,  # False for faster debugging/testing but it won't be shuffled
+                                streaming: bool = True,
+                                prefetch_depth: int = 2,  # batches fetched & tokenized ahead in the background, 0 for none
+                                embedding_store: EmbeddingStore = None,  # reuse embeddings computed before (and store the new ones)
                             ) -> dict:
     """ """
     # - Compute embedding of target
     losses: list[dict] = []
     embeddings: list[dict] = []
     cross_distances = []
-    for batch_num in range(num_batches):
+    # reuse the probe network across batches (restoring its lm_head after each batch) instead of deep copying it
+    probe_session = ProbeSession(probe_network)
+    probe_hash = probe_network_hash(probe_network) if embedding_store is not None else None
+    info_target = {**dataset_id(dataset_target), 'tokenizer': tokenizer_id(tokenizer)}
+    info_source = {**dataset_id(dataset_source), 'tokenizer': tokenizer_id(tokenizer)}
+    # single pass over each (shuffled) data set that hands out num_batches disjoint batches
+    target_batches = iter_disjoint_batches(dataset_target, batch_size, num_batches, seed=seed, buffer_size=buffer_size, shuffle=shuffle, streaming=streaming)
+    source_batches = iter_disjoint_batches(dataset_source, batch_size, num_batches, seed=seed, buffer_size=buffer_size, shuffle=shuffle, streaming=streaming)
+    # (tokenized) batches are prepared in the background while the previous ones are being embedded
+    target_batches = tokenized_batches(target_batches, map_target, prefetch_depth=prefetch_depth)
+    source_batches = tokenized_batches(source_batches, map_source, prefetch_depth=prefetch_depth)
+    for (batch_num, batch_seed, target_batch), (_, _, source_batch) in zip(target_batches, source_batches):
         # - Get target shuffled data
-        shuffled_dataset = dataset_target.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset_target
-        raw_text_batch = shuffled_dataset.take(batch_size)
-        tokenized_batch = map_target(raw_text_batch)
+        tokenized_batch = target_batch
         
         # - Get Task2Vec embedding for batch
-        if not debug:
-            embedding_target, loss_target = Task2Vec(probe_network, classifier_opts={'seed': seed}).embed(tokenized_batch)
-        else:
-            embedding_target, loss_target = Task2Vec(probe_network, classifier_opts={'break_early': True, 'seed': seed}).embed(tokenized_batch, epochs=1)  # only for debugging
+        embedding_target, loss_target = get_task2vec_embedding(probe_session, tokenized_batch, batch_seed, debug=debug, embedding_store=embedding_store,
+                                                               probe_hash=probe_hash, batch_num=batch_num, **info_target)
         print(f'{loss_target=}\n{embedding_target=}\n') if verbose else None
 
         # - Get source shuffled data
-        shuffled_dataset = dataset_source.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset_source
-        raw_text_batch = shuffled_dataset.take(batch_size)
-        tokenized_batch = map_target(raw_text_batch)
+        tokenized_batch = source_batch
         
         # - Get Task2Vec embedding for batch
-        if not debug:
-            embedding_source, loss_source = Task2Vec(probe_network, classifier_opts={'seed': seed}).embed(tokenized_batch)
-        else:
-            embedding_source, loss_source = Task2Vec(probe_network, classifier_opts={'break_early': True, 'seed': seed}).embed(tokenized_batch, epochs=1)  # only for debugging
+        embedding_source, loss_source = get_task2vec_embedding(probe_session, tokenized_batch, batch_seed, debug=debug, embedding_store=embedding_store,
+                                                               probe_hash=probe_hash, batch_num=batch_num, **info_source)
         print(f'{loss_source=}\n{embedding_source=}\n') if verbose else None
 
         # - Append results to save later
@@ -0,0 +1,171 @@
+"""
+Persistent, content addressed store of Task2Vec embeddings, so batches embedded by one run (e.g., a diversity
+coefficient) are reused by the next ones (e.g., a cross diversity/alignment run with the same data and probe network).
+
+A store is a directory with:
+    - hessians.f32: append-only raw float32 array with the hessian (diagonal of the FIM) of every embedding back to back,
+    read with np.memmap (so opening a store doesn't load it),
+    - index.jsonl: one json line per embedding, {key, offset, size, loss, meta, info} with offset/size in float32 entries
+    (and sketch_offset/sketch_size if the embedding has a sketch, see diversity.sketching).
+Both files are only appended to (and fsync'ed, the hessian before its index line), so a crashed run leaves at most a
+truncated last record, which is skipped on load.
+
+The key of an embedding hashes the tokenized batch itself (its input ids/attention mask/labels, so it covers the data
+set, split, batch seed, batch size, sequence length and tokenizer), a hash of the probe network weights and the
+Task2Vec options. The human readable fields (data set, split, batch seed, ...) are kept in the record's info.
+
+Note: only the hessian (and sketch) is stored, the scale of autoregressive embeddings is all ones.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from diversity.task2vec import Embedding, MaterializedBatch
+
+
+def _tensor_bytes(tensor: torch.Tensor) -> bytes:
+    # view as bytes so it also works for dtypes numpy doesn't have (e.g., bfloat16)
+    return tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes()
+
+
+def probe_network_hash(probe_network: nn.Module) -> str:
+    """ sha256 of the probe network's weights (names, shapes, dtypes and values). """
+    sha = hashlib.sha256()
+    for name, tensor in probe_network.state_dict().items():
+        sha.update(f'{name} {tuple(tensor.shape)} {tensor.dtype}'.encode())
+        sha.update(_tensor_bytes(tensor))
+    return sha.hexdigest()
+
+
+def batch_hash(batch: MaterializedBatch) -> str:
+    """ sha256 of the content of a tokenized (materialized) batch. """
+    sha = hashlib.sha256()
+    for tensor in (batch.input_ids, batch.attention_mask, batch.labels):
+        sha.update(f'{tuple(tensor.shape)}'.encode())
+        sha.update(_tensor_bytes(tensor.long() if tensor.dtype != torch.bool else tensor))
+    return sha.hexdigest()
+
+
+def embedding_key(**fields) -> str:
+    """ Key of an embedding from json serializable fields (e.g., batch=batch_hash(batch), probe_network=..., classifier_opts=...). """
+    return hashlib.sha256(json.dumps(fields, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def dataset_id(dataset) -> dict:
+    """ Best effort name/config/split of a HF data set (for the info of the stored records). """
+    info = getattr(dataset, 'info', None)
+    return {'dataset': getattr(info, 'dataset_name', None) or getattr(info, 'builder_name', None),
+            'config': getattr(info, 'config_name', None),
+            'split': None if getattr(dataset, 'split', None) is None else str(dataset.split)}
+
+
+def tokenizer_id(tokenizer) -> Optional[str]:
+    return None if tokenizer is None else getattr(tokenizer, 'name_or_path', type(tokenizer).__name__)
+
+
+class EmbeddingStore:
+    """
+    store = EmbeddingStore('~/data/task2vec_store')
+    stored = store.get(key)  # (embedding, loss) or None
+    store.put(key, embedding, loss, dataset='c4', batch_seed=42)
+    """
+
+    def __init__(self, path):
+        self.path = Path(path).expanduser()
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.hessians_path = self.path / 'hessians.f32'
+        self.index_path = self.path / 'index.jsonl'
+        self.hessians_path.touch(exist_ok=True)
+        self.index: dict[str, dict] = {}
+        self._missing_newline = False  # e.g., the index ends in a truncated line
+        self._load_index()
+
+    def _load_index(self):
+        if not self.index_path.exists():
+            return
+        num_entries = self.hessians_path.stat().st_size // 4
+        with open(self.index_path) as f:
+            for line in f:
+                self._missing_newline = not line.endswith('\n')
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # truncated last line of a crashed run
+                if record['offset'] + record['size'] + record.get('sketch_size', 0) <= num_entries:
+                    self.index[record['key']] = record
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, key: str) -> Optional[tuple[Embedding, Optional[float]]]:
+        record = self.index.get(key)
+        if record is None:
+            return None
+        hessian, scale, sketch = None, None, None
+        if record['size'] > 0:
+            hessian = self._read(record['offset'], record['size'])
+        if record.get('sketch_size'):
+            sketch = np.array(self._read(record['sketch_offset'], record['sketch_size']))
+        embedding = Embedding(hessian=hessian, scale=scale, meta=record['meta'], sketch=sketch)
+        return embedding, record['loss']
+
+    def _read(self, offset: int, size: int) -> np.ndarray:
+        return np.memmap(self.hessians_path, dtype=np.float32, mode='r', offset=4 * offset, shape=(size,))
+
+    def put(self, key: str, embedding: Embedding, loss: Optional[float] = None, **info):
+        if key in self.index:
+            return
+        hessian = np.zeros(0, dtype=np.float32) if embedding.hessian is None else np.ascontiguousarray(embedding.hessian, dtype=np.float32).reshape(-1)
+        sketch = getattr(embedding, 'sketch', None)
+        sketch = np.zeros(0, dtype=np.float32) if sketch is None else np.ascontiguousarray(sketch, dtype=np.float32).reshape(-1)
+        with open(self.hessians_path, 'ab') as f:
+            position = f.tell()
+            if position % 4 != 0:  # partial write of a crashed run, re-align to float32 entries
+                f.write(b'\0' * (4 - position % 4))
+                position += 4 - position % 4
+            f.write(hessian.tobytes())
+            f.write(sketch.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        record = {'key': key, 'offset': position // 4, 'size': hessian.size, 'loss': loss, 'meta': embedding.meta, 'info': info}
+        if sketch.size > 0:
+            record.update(sketch_offset=position // 4 + hessian.size, sketch_size=sketch.size)
+        with open(self.index_path, 'a') as f:
+            f.write(('\n' if self._missing_newline else '') + json.dumps(record, default=str) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._missing_newline = False
+        self.index[key] = record
+
+# -- Tests, examples
+
+def test_embedding_store():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        store = EmbeddingStore(tmp)
+        embeddings = [Embedding(hessian=np.random.rand(n).astype(np.float32), scale=np.ones(n)) for n in (5, 7)]
+        for i, embedding in enumerate(embeddings):
+            store.put(embedding_key(batch=i), embedding, loss=float(i), batch_seed=i)
+        # reopening reads the same embeddings back, a truncated last record of a crashed run is ignored
+        with open(store.index_path, 'a') as f:
+            f.write('{"key": "trunc')
+        store = EmbeddingStore(tmp)
+        assert len(store) == 2 and embedding_key(batch=2) not in store
+        store.put(embedding_key(batch=2), embeddings[0], loss=2.0)
+        assert len(EmbeddingStore(tmp)) == 3
+        for i, embedding in enumerate(embeddings):
+            stored, loss = store.get(embedding_key(batch=i))
+            assert np.array_equal(stored.hessian, embedding.hessian) and loss == i
+    print('Success!')
+
+if __name__ == '__main__':
+    test_embedding_store()
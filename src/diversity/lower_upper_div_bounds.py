@@ -35,6 +35,8 @@ import torch
 import sys  
 from datasets import Dataset
 
+from diversity.batch_sampling import IndexSampler
+
 # Generate a single sample/sequence
 
 def gen_lb_seq(tokenizer, max_length: int = 128):
@@ -172,10 +174,11 @@ def test_lb_ds_looping_with_div_coeff_map_code():
 
   # once we have the datasets as a table with columns as the samples/seqs and rows as the exact sample, sample a batch samples (a batch of size batch_size)
   # --
+  index_sampler = IndexSampler(len(dataset), seed=seed, disjoint=False)
   for batch_sum in range(num_batches):
     shuffled_dataset = dataset.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset
     # sample batch of samples/rows from data set
-    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(list(range(len(shuffled_dataset))), batch_size))
+    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(index_sampler.sample(batch_size))
     # raw_text_batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(batch_size, batch_size))
     # tokenized_batch = map(raw_text_batch) will this being the identity work?
     tokenized_batch = map(lambda x: x, batch) #  will this being the identity work?
@@ -188,10 +191,11 @@ def test_lb_ds_looping_with_div_coeff_map_code():
 
   # once we have the datasets as a table with columns as the samples/seqs and rows as the exact sample, sample a batch samples (a batch of size batch_size)
   # --
+  index_sampler = IndexSampler(len(dataset), seed=seed, disjoint=False)
   for batch_sum in range(num_batches):
     shuffled_dataset = dataset.shuffle(buffer_size=buffer_size, seed=seed) if shuffle else dataset
     # sample batch of samples/rows from data set
-    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(list(range(len(shuffled_dataset))), batch_size))
+    batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(index_sampler.sample(batch_size))
     # raw_text_batch = shuffled_dataset.take(batch_size) if streaming else shuffled_dataset.select(random.sample(batch_size, batch_size))
     # tokenized_batch = map(raw_text_batch) will this being the identity work?
     # tokenized_batch = map(lambda x: x, batch) #  will this being the identity work?
@@ -1,6 +1,7 @@
-from copy import deepcopy
 from pathlib import Path
 import os
+import shutil
+import uuid
 import argparse
 import json
 import time
@@ -8,8 +9,13 @@ import numpy as np
 import torch
 import math
 
-from task2vec import Task2Vec
-import task_similarity
+# (package imports like div_coeff, so there is one diversity.task2vec, e.g., one Embedding class, and one tracing module)
+from diversity.task2vec import ProbeSession, materialize_batch, save_embeddings, load_embeddings
+import diversity.task_similarity as task_similarity
+from diversity.batch_sampling import prefetch
+from diversity.work_ledger import WorkLedger, atomic_write_text
+from diversity.embedding_store import EmbeddingStore, embedding_key, probe_network_hash
+from diversity.profiling import enable_tracing, stage, read_trace, summarize, print_summary
 
 from datasets import load_dataset
 from transformers import AutoConfig, GPT2Tokenizer, GPT2LMHeadModel
@@ -67,9 +73,34 @@ def main():
                         help="random seed for initialization")
     parser.add_argument('--overwrite_output_dir', action='store_true',
                         help="Overwrite the content of the output directory")
+    parser.add_argument('--trace', action='store_true',
+                        help="Trace the time, cpu, memory and tokens of every stage to output_dir/trace.jsonl (summarized at the end).")
+    parser.add_argument('--resume', action='store_true',
+                        help="Resume a crashed/killed run in output_dir: tasks in its checkpoint are reloaded instead of recomputed.")
+    parser.add_argument('--prefetch_depth', type=int, default=2,
+                        help="Number of tasks fetched and tokenized ahead in the background while a task is embedded (0 for none).")
+    parser.add_argument('--condensed_distances', action='store_true',
+                        help="Save the distance matrix in condensed form (the pairs i < j, see scipy's squareform), half the size.")
+    ## Sharded (multi-node) runs
+    parser.add_argument('--shard_size', type=int, default=None,
+                        help="Sharded mode: split the tasks into shards of this many tasks, claimed by the hosts running main.py \
+                            with the same (shared) output_dir through a work ledger. Each shard is saved to output_dir/shards, \
+                            run with --merge once they are done to get the distance matrix and div coeff.")
+    parser.add_argument('--stale_after', type=float, default=900,
+                        help="Sharded mode: seconds without a heartbeat after which the shard of a killed host is claimed again.")
+    parser.add_argument('--merge', action='store_true',
+                        help="Merge the shards of a sharded run in output_dir into the distance matrix and div coeff.")
     args = parser.parse_args()
 
-    if os.path.exists(args.output_dir) and os.listdir(
+    if args.merge:
+        if args.trace:
+            enable_tracing(os.path.join(args.output_dir, 'trace.jsonl'))
+        merge_shards(args)
+        return
+
+    sharded: bool = args.shard_size is not None
+    # hosts of a sharded run share the output dir
+    if not sharded and not args.resume and os.path.exists(args.output_dir) and os.listdir(
             args.output_dir) and not args.overwrite_output_dir:
         raise ValueError(
             "Output directory ({}) already exists and is not empty. Use --overwrite_output_dir to overcome.".format(
@@ -80,6 +111,8 @@ def main():
     with open(os.path.join(args.output_dir, 'run_args.txt'), 'w') as f:
         f.write(json.dumps(args.__dict__, indent=2))
         f.close()
+    if args.trace:
+        enable_tracing(os.path.join(args.output_dir, 'trace.jsonl'))
     
     # Load dataset
     ds_dict = {}
@@ -138,6 +171,8 @@ def main():
         print("USING RANDOM MODEL")
         config = AutoConfig.from_pretrained('gpt2')
         tokenizer = GPT2Tokenizer.from_pretrained("gpt2", cache_dir=args.cache_dir if args.cache_dir else None)
+        # seeded, so a resumed run (or another host of a sharded run) embeds with the same random probe network
+        torch.manual_seed(args.seed)
         model = GPT2LMHeadModel(config)
 
     device = torch.device(f"cuda:{0}" if torch.cuda.is_available() else "cpu")
@@ -149,7 +184,8 @@ def main():
 
     # Tokenize examples
     def preprocess_function(examples):
-        return tokenizer(examples["text"], padding="max_length", max_length=args.max_seq_length, truncation=True, return_tensors="pt")
+        with stage('tokenize', examples=len(examples["text"])):
+            return tokenizer(examples["text"], padding="max_length", max_length=args.max_seq_length, truncation=True, return_tensors="pt")
     
     def process_and_filter(batch):
         """This function removes empty examples."""
@@ -165,47 +201,78 @@ def main():
         
     # Compute Task2Vec embeddings
     embeddings, losses = [], []
+    # reuse the probe network for every task (its lm_head is restored after each task) instead of deep copying it
+    probe_session = ProbeSession(model)
+
+    def get_tokenized_tasks(ds, task_nums=None):
+        for task_num in (range(args.num_tasks) if task_nums is None else task_nums):
+            seed = args.seed + task_num
+            shuffled_dataset = ds.shuffle(buffer_size=args.buffer_size, seed=seed)
+            task_dataset = shuffled_dataset.take(args.batch_size)
+            tokenized_task_dataset = task_dataset.map(preprocess_function, batched=True, remove_columns=remove_columns)
+            # streaming: fetching (shuffle buffer) and tokenizing happen here, the tokenize stages inside it tell them apart
+            with stage('fetch_task', task_num=task_num) as fetch:
+                batch = materialize_batch(tokenized_task_dataset)
+                fetch.add(examples=len(batch), tokens=int(batch.attention_mask.sum()))
+            yield task_num, batch
+
+    if sharded:
+        # tasks only depend on their task_num (seed + task_num), so any host can compute any shard
+        os.makedirs(os.path.join(args.output_dir, 'shards'), exist_ok=True)
+        atomic_write_text(os.path.join(args.output_dir, 'shards', 'datasets.json'), json.dumps(list(ds_dict)))
+        for key, ds in ds_dict.items():
+            print("CURRENT DATASET: ", key)
+            run_shards(args, key, ds, probe_session, get_tokenized_tasks)
+        print(f'No shards left to claim, run with --merge once all hosts are done: {args.output_dir=}')
+        return
+
+    # Append-only checkpoint (one fsync'ed record per task, see EmbeddingStore), so a crashed run can be resumed
+    checkpoint_dir = os.path.join(args.output_dir, 'checkpoint')
+    if not args.resume and os.path.isdir(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)  # (--overwrite_output_dir)
+    checkpoint = EmbeddingStore(checkpoint_dir)
+    probe_hash: str = probe_network_hash(model)
+
+    def task_key(key: str, task_num: int) -> str:
+        return embedding_key(dataset=key, task_num=task_num, seed=args.seed + task_num, probe_network=probe_hash,
+                             finetune=args.finetune, epochs=args.epochs, break_early=args.break_early, batch_size=args.batch_size,
+                             buffer_size=args.buffer_size, max_seq_length=args.max_seq_length)
+
     for key, ds in ds_dict.items():
         print("CURRENT DATASET: ", key)
-        for task_num in range(args.num_tasks):
+        task_nums = [task_num for task_num in range(args.num_tasks) if task_key(key, task_num) not in checkpoint]
+        if len(task_nums) < args.num_tasks:
+            print(f'Resuming: {args.num_tasks - len(task_nums)} tasks of {key=} are in the checkpoint')
+        # tasks are fetched & tokenized in the background while the previous task is being embedded
+        for task_num, tokenized_task_dataset in prefetch(get_tokenized_tasks(ds, task_nums), depth=args.prefetch_depth):
             print(f'--> {task_num=}\n')
             seed = args.seed + task_num
             classifier_opts = {'break_early': args.break_early, "finetune": args.finetune, "seed": seed, "epochs": args.epochs, 
                 "task_batch_size": args.batch_size}
             
-            shuffled_dataset = ds.shuffle(buffer_size=args.buffer_size, seed=seed)
-            task_dataset = shuffled_dataset.take(args.batch_size)
-            tokenized_task_dataset = task_dataset.map(preprocess_function, batched=True, remove_columns=remove_columns)
-            
-            probe_network = model
             start = time.time()
-            embedding, loss = Task2Vec(deepcopy(probe_network), classifier_opts=classifier_opts).embed(tokenized_task_dataset)
+            embedding, loss = probe_session.embed(tokenized_task_dataset, classifier_opts=classifier_opts)
             end = time.time()
             print("TIME TO COMPUTE TASK2VEC:", end - start)
             print(f'{embedding.hessian.shape=}')
-            embeddings.append(embedding)
-            if loss is not None:
-                losses.append(loss)
-            
-            # Save embeddings and loss in output_dir, and overwrite existing embeddings and loss checkpt files.
-            num_tasks_processed = task_num + 1
-            np.save(os.path.join(args.output_dir, key + '_embeddings_' + str(num_tasks_processed) + 'tasks.npy'), embeddings)
+            checkpoint.put(task_key(key, task_num), embedding, loss, dataset=key, task_num=task_num, seed=seed)
+
+        # Read the tasks back from the checkpoint in order (float32, the same whether the run was resumed or not)
+        key_embeddings, key_losses = [], []
+        for task_num in range(args.num_tasks):
+            embedding, loss = checkpoint.get(task_key(key, task_num))
+            key_embeddings.append(embedding)
             if loss is not None:
-                np.save(os.path.join(args.output_dir, key + '_loss_' + str(num_tasks_processed) + 'tasks.npy'), losses)
-            
-            # Remove previous checkpt files.
-            last_num_tasks = num_tasks_processed - 1
-            if last_num_tasks > 0:
-                last_file = os.path.join(args.output_dir, key + '_embeddings_' + str(last_num_tasks) + 'tasks.npy')
-                if os.path.isfile(last_file):
-                    os.remove(last_file)
-                if loss is not None:
-                    last_file = os.path.join(args.output_dir, key + '_loss_' + str(last_num_tasks) + 'tasks.npy')
-                    if os.path.isfile(last_file):
-                        os.remove(last_file)
+                key_losses.append(loss)
+        embeddings.extend(key_embeddings)
+        losses.extend(key_losses)
+        # Save embeddings and loss of the data set in output_dir (once, the checkpoint has them per task while running)
+        np.save(os.path.join(args.output_dir, key + '_embeddings_' + str(args.num_tasks) + 'tasks.npy'), key_embeddings)
+        if key_losses:
+            np.save(os.path.join(args.output_dir, key + '_loss_' + str(args.num_tasks) + 'tasks.npy'), key_losses)
 
     # Compute pairwise cosine distance matrix between Task2Vec embeddings
-    distance_matrix: np.ndarray = task_similarity.pdist(embeddings, distance='cosine')
+    distance_matrix: np.ndarray = task_similarity.pdist(embeddings, distance='cosine', condensed=args.condensed_distances)
     print(f'{distance_matrix=}')
     np.save(os.path.join(args.output_dir, 'distance_matrix.npy'), distance_matrix)
 
@@ -214,6 +281,119 @@ def main():
                      'losses': [loss for loss in losses],
                      "num_tasks": args.num_tasks}
     np.save(os.path.join(args.output_dir, 'results.npy'), results)
-    
+    if args.trace:
+        print_summary(summarize(read_trace(os.path.join(args.output_dir, 'trace.jsonl'))))
+
+
+def ledger_layout(args, create: bool = False) -> dict:
+    """
+    {num_tasks, shard_size} of the sharded run in output_dir, saved to ledger/layout.json by the first host (create), so
+    the other hosts are checked against it and --merge doesn't need the flags repeated.
+    """
+    path = os.path.join(args.output_dir, 'ledger', 'layout.json')
+    if create:
+        layout = {'num_tasks': args.num_tasks, 'shard_size': args.shard_size}
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.tmp-{uuid.uuid4().hex[:8]}'
+        atomic_write_text(tmp_path, json.dumps(layout))
+        try:
+            os.link(tmp_path, path)  # atomic create if it doesn't exist yet (complete, unlike O_EXCL + write)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_path)
+    if not os.path.exists(path):
+        raise ValueError(f'No sharded run in {args.output_dir=} (missing {path=}), run main.py with --shard_size first')
+    with open(path) as f:
+        saved: dict = json.load(f)
+    if create and saved != layout:
+        raise ValueError(f'Sharded run in {args.output_dir=} has {saved=}, got {layout=} (use the same --num_tasks/--shard_size on all hosts)')
+    return saved
+
+
+def get_ledger(args, key: str, layout: dict) -> WorkLedger:
+    return WorkLedger(os.path.join(args.output_dir, 'ledger', key), num_items=layout['num_tasks'], shard_size=layout['shard_size'],
+                      stale_after=args.stale_after)
+
+
+def shard_dir(args, key: str, shard: int) -> str:
+    return os.path.join(args.output_dir, 'shards', key, f'shard_{shard:05d}')
+
+
+def run_shards(args, key: str, ds, probe_session: ProbeSession, get_tokenized_tasks):
+    """ Claims shards of the tasks of data set key until none are left, saving the embeddings/losses of each to its shard dir. """
+    ledger = get_ledger(args, key, ledger_layout(args, create=True))
+    while (shard := ledger.claim()) is not None:
+        task_nums = ledger.items(shard)
+        print(f'--> {key=} {shard=} {task_nums=} {ledger.owner=}')
+        embeddings, losses = [], []
+        try:
+            with ledger.heartbeat(shard):
+                for task_num, tokenized_task_dataset in prefetch(get_tokenized_tasks(ds, task_nums), depth=args.prefetch_depth):
+                    seed = args.seed + task_num
+                    classifier_opts = {'break_early': args.break_early, "finetune": args.finetune, "seed": seed, "epochs": args.epochs,
+                        "task_batch_size": args.batch_size}
+                    start = time.time()
+                    embedding, loss = probe_session.embed(tokenized_task_dataset, classifier_opts=classifier_opts)
+                    print(f'{task_num=} TIME TO COMPUTE TASK2VEC: {time.time() - start}')
+                    embeddings.append(embedding)
+                    losses.append(np.nan if loss is None else loss)
+                # - write the shard to a temporary dir then rename it, so a shard dir is always complete
+                path = shard_dir(args, key, shard)
+                tmp_path = f'{path}.tmp-{uuid.uuid4().hex[:8]}'
+                save_embeddings(embeddings, tmp_path)
+                np.save(os.path.join(tmp_path, 'task_nums.npy'), np.array(task_nums))
+                np.save(os.path.join(tmp_path, 'losses.npy'), np.array(losses, dtype=float))
+                try:
+                    os.rename(tmp_path, path)
+                except OSError:
+                    # done by another host too (e.g., it took over our claim while we were presumed dead), same results
+                    shutil.rmtree(tmp_path)
+        except BaseException:
+            ledger.release(shard)
+            raise
+        ledger.done(shard)
+
+
+def merge_shards(args):
+    """ Distance matrix and div coeff of the tasks of all data sets from the shards of a finished sharded run. """
+    with open(os.path.join(args.output_dir, 'shards', 'datasets.json')) as f:
+        keys: list = json.load(f)
+    # the layout of the run (not the flags of this command, e.g., --shard_size needn't be repeated)
+    layout: dict = ledger_layout(args)
+    embeddings, losses = [], []
+    for key in keys:
+        ledger = get_ledger(args, key, layout)
+        missing = [shard for shard in range(ledger.num_shards) if not ledger.is_done(shard)]
+        if missing:
+            raise ValueError(f'Shards of {key=} are not done yet (killed hosts\' shards are claimed again after '
+                             f'{args.stale_after=}s), got: {missing=}')
+        for shard in range(ledger.num_shards):
+            path = shard_dir(args, key, shard)
+            task_nums = np.load(os.path.join(path, 'task_nums.npy'))
+            assert list(task_nums) == list(ledger.items(shard)), f'Err: {path=} has {task_nums=}, expected {ledger.items(shard)}'
+            embeddings.extend(load_embeddings(path))
+            losses.extend(np.load(os.path.join(path, 'losses.npy')))
+    print(f'Merged {len(embeddings)} embeddings of {keys=}')
+
+    # Compute pairwise cosine distance matrix between Task2Vec embeddings
+    distance_matrix: np.ndarray = task_similarity.pdist(embeddings, distance='cosine', condensed=args.condensed_distances)
+    # same stats as get_diversity_coefficient (div_coeff_ci is the std of the distances, not a bootstrap ci)
+    variance_type = 'std'
+    div_coeff, div_coeff_ci = task_similarity.stats_of_distance_matrix(distance_matrix, variance_type=variance_type)
+    print(f'{div_coeff=} {div_coeff_ci=} ({variance_type=})')
+    np.save(os.path.join(args.output_dir, 'distance_matrix.npy'), distance_matrix)
+
+    results: dict = {'embeddings': [embed for embed in embeddings],
+                     'distance_matrix': distance_matrix,
+                     'losses': [loss for loss in losses if not np.isnan(loss)],
+                     "num_tasks": layout['num_tasks'],
+                     'div_coeff': div_coeff,
+                     'div_coeff_ci': div_coeff_ci,
+                     'div_coeff_variance_type': variance_type}
+    np.save(os.path.join(args.output_dir, 'results.npy'), results)
+    if args.trace:
+        print_summary(summarize(read_trace(os.path.join(args.output_dir, 'trace.jsonl'))))
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,4 +1,3 @@
-from copy import deepcopy
 from pathlib import Path
 import os
 import argparse
@@ -7,7 +6,7 @@ import numpy as np
 import torch
 import math
 
-from task2vec import Task2Vec
+from task2vec import ProbeSession
 import task_similarity
 
 from datasets import load_dataset
@@ -189,6 +188,8 @@ def main():
     num_tasks = math.ceil(len(lm_datasets) / args.batch_size)
     print("NUM_TASKS:", num_tasks)
     embeddings, losses = [], []
+    # reuse the probe network for every task (its lm_head is restored after each task) instead of deep copying it
+    probe_session = ProbeSession(model)
     for task_num in range(num_tasks):
         print(f'--> {task_num=}\n')
         seed = args.seed + task_num
@@ -199,8 +200,7 @@ def main():
             end_index = len(lm_datasets)
         tokenized_task_dataset = lm_datasets.select(range(task_num * args.batch_size, end_index))
 
-        probe_network = model
-        embedding, loss = Task2Vec(deepcopy(probe_network), classifier_opts=classifier_opts).embed(tokenized_task_dataset)
+        embedding, loss = probe_session.embed(tokenized_task_dataset, classifier_opts=classifier_opts)
         print(f'{embedding.hessian.shape=}')
         embeddings.append(embedding)
         if loss is not None:
@@ -0,0 +1,130 @@
+"""
+Process-parallel Task2Vec embedding of many batches on CPU nodes.
+
+PyTorch's intra-op threading scales poorly for a GPT-2 probe network on small batches (e.g., 8 sequences), so instead of
+one process with all the cores we start num_workers processes with a share of the cores each. Every worker loads the
+probe network once (a ProbeSession, so nothing is copied per batch) and pulls batches from the pool's shared task queue.
+Results are handed back in the order the batches were submitted and every batch is embedded from the same probe
+network state with its own seed (see ProbeSession), so the embeddings don't depend on num_workers. The number of torch
+threads can change the order of float reductions, so by default every worker uses as many threads as this process
+(torch.get_num_threads()), which gives the same embeddings as embedding in this process (bitwise). For throughput pass
+threads_per_worker (e.g., 1, or the number of cores // num_workers), the embeddings then depend on it (but still not on
+num_workers).
+
+Uses the spawn start method (fork + torch threads is unsafe), so scripts using it need the usual
+`if __name__ == '__main__':` guard.
+"""
+import os
+import pickle
+from collections import deque
+from typing import Iterable, Iterator, Optional
+
+import torch
+import torch.multiprocessing as mp
+
+from diversity.task2vec import ProbeSession
+
+_SESSION: Optional[ProbeSession] = None
+
+
+def available_cores() -> list[int]:
+    return sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+
+
+def _init_worker(probe_network_bytes: bytes, threads_per_worker: int, pin_cores: bool, worker_counter, layer_opts, sketch_opts):
+    global _SESSION
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    if pin_cores and hasattr(os, 'sched_setaffinity'):
+        # worker i gets cores [i * threads_per_worker, (i + 1) * threads_per_worker) (wrapping around if oversubscribed)
+        cores = available_cores()
+        os.sched_setaffinity(0, {cores[(worker_index * threads_per_worker + k) % len(cores)] for k in range(threads_per_worker)})
+    torch.set_num_threads(threads_per_worker)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # already set (e.g., torch did parallel work while unpickling)
+    _SESSION = ProbeSession(pickle.loads(probe_network_bytes), layer_opts=layer_opts, sketch_opts=sketch_opts)
+
+
+def _embed(batch, embed_kwargs: dict):
+    return _SESSION.embed(batch, **embed_kwargs)
+
+
+class EmbeddingPool:
+    """
+    with EmbeddingPool(probe_network, num_workers=8) as pool:
+        for embedding, loss in pool.imap((batch, {'classifier_opts': {'seed': seed}, 'epochs': 5}) for ...):
+            ...
+
+    threads_per_worker defaults to torch.get_num_threads() of this process (see above). At most max_in_flight
+    (default 2 * num_workers) batches are submitted but not yet returned, so a streaming iterable of batches isn't
+    read (and kept in memory) ahead of the workers.
+    """
+
+    def __init__(self,
+                 probe_network,
+                 num_workers: int,
+                 threads_per_worker: int = None,
+                 pin_cores: bool = True,
+                 max_in_flight: int = None,
+                 layer_opts: dict = None,
+                 sketch_opts: dict = None,
+                 ):
+        self.num_workers = num_workers
+        # not a share of the cores: that would depend on num_workers, and so would the embeddings
+        self.threads_per_worker = threads_per_worker or torch.get_num_threads()
+        self.max_in_flight = max_in_flight or 2 * num_workers
+        ctx = mp.get_context('spawn')
+        # plain pickle so every worker gets its own copy of the weights: torch's multiprocessing pickler would move them to
+        # shared memory, and the workers fine-tune the lm_head (tied to the input embeddings in GPT-2) in place
+        self.pool = ctx.Pool(num_workers, initializer=_init_worker,
+                             initargs=(pickle.dumps(probe_network), self.threads_per_worker, pin_cores, ctx.Value('i', 0), layer_opts, sketch_opts))
+
+    def submit(self, batch, embed_kwargs: dict):
+        """ Queues ProbeSession.embed(batch, **embed_kwargs) for the next free worker, .get() returns (embedding, loss). """
+        return self.pool.apply_async(_embed, (batch, embed_kwargs))
+
+    def imap(self, tasks: Iterable[tuple]) -> Iterator[tuple]:
+        """ Yields (embedding, loss) for every (batch, embed_kwargs) of tasks, in order. """
+        pending = deque()
+        for batch, embed_kwargs in tasks:
+            pending.append(self.submit(batch, embed_kwargs))
+            if len(pending) >= self.max_in_flight:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def close(self, terminate: bool = False):
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # e.g., stopping early (online div coeff) or an error: don't wait for the batches still queued
+        self.close(terminate=True)
+
+# -- Tests, examples
+
+def test_embedding_pool():
+    from diversity.benchmarks import synthetic_batch, tiny_probe_network
+    batches = [synthetic_batch(num_sequences=4, max_length=32, seed=seed) for seed in range(3)]
+    tasks = [(batch, {'classifier_opts': {'seed': seed}, 'epochs': 1}) for seed, batch in enumerate(batches)]
+    session = ProbeSession(tiny_probe_network(max_length=32))
+    sequential = [session.embed(batch, **embed_kwargs) for batch, embed_kwargs in tasks]
+    # default settings: same embeddings (bitwise) as in this process, whatever num_workers is
+    for num_workers in (1, 2):
+        with EmbeddingPool(tiny_probe_network(max_length=32), num_workers=num_workers) as pool:
+            parallel = list(pool.imap(tasks))
+        assert all(torch.equal(torch.from_numpy(e.hessian), torch.from_numpy(p.hessian)) and loss == p_loss
+                   for (e, loss), (p, p_loss) in zip(sequential, parallel)), f'Err: embeddings differ with {num_workers=}'
+    print('Success!')
+
+if __name__ == '__main__':
+    test_embedding_pool()
@@ -0,0 +1,268 @@
+"""
+Stage-level tracing of the diversity pipeline to a JSON lines file, to tell whether a (slow) run is bound by fetching
+data (I/O), tokenizing, the forward/backward passes of fine-tuning or the Fisher, or the distances.
+
+Tracing is off unless enabled, with enable_tracing(path) or the DIVERSITY_TRACE=path env var (inherited by worker
+processes, e.g., of parallel_embedding, which append to the same file). Off, a stage is a flag check.
+
+    with stage('fetch_batch', batch_num=3) as s:
+        batch = ...
+        s.add(examples=len(batch), tokens=num_tokens)
+
+    @traced()  # (in it, current_stage() is the function's stage)
+    def fit(...):
+        with current_stage().timed('backward_s'):
+            loss.backward()
+
+writes one record per stage when it exits: {stage, id, parent, depth, pid, thread, start, wall_s, cpu_s, peak_rss_mb,
+error, **fields, **counters}. cpu_s is the process CPU time (all threads, incl. torch's) during the stage, so
+cpu_s / wall_s ~ 1 is one busy core and << 1 is waiting (e.g., on I/O or a GPU). peak_rss_mb is the peak resident memory
+of the process so far (it's a high-water mark, so it's only attributable to the stage where it goes up). Timings inside
+a stage (timed) synchronize cuda first, else they'd time the kernel launches.
+
+Summarize a trace with `python -m diversity.profiling trace.jsonl` (total/self wall time, cpu, tokens/s per stage).
+"""
+import argparse
+import functools
+import itertools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from typing import Optional
+
+_TRACE_ENV = 'DIVERSITY_TRACE'
+_trace_path: Optional[str] = os.environ.get(_TRACE_ENV) or None
+_trace_file = None
+_lock = threading.Lock()
+_local = threading.local()
+_ids = itertools.count()
+
+
+def enable_tracing(path):
+    """ Appends stage records to path from now on (also in worker processes started later). """
+    global _trace_path
+    disable_tracing()
+    _trace_path = os.fspath(path)
+    os.environ[_TRACE_ENV] = _trace_path
+
+
+def disable_tracing():
+    global _trace_path, _trace_file
+    with _lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_path, _trace_file = None, None
+    os.environ.pop(_TRACE_ENV, None)
+
+
+def tracing_enabled() -> bool:
+    return _trace_path is not None
+
+
+def _write(record: dict):
+    global _trace_file
+    line = json.dumps(record, default=str) + '\n'
+    with _lock:
+        if _trace_path is None:
+            return
+        if _trace_file is None:
+            _trace_file = open(_trace_path, 'a')
+        _trace_file.write(line)
+        _trace_file.flush()
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10  # bytes on macOS, KiB on Linux
+
+
+def _cuda_synchronize():
+    torch = sys.modules.get('torch')
+    if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+        torch.cuda.synchronize()
+
+
+class Stage:
+    """ A running stage, counters (add) and timings (timed) go into its record. """
+
+    def __init__(self, name: str, fields: dict):
+        self.id = f'{os.getpid()}-{next(_ids)}'
+        self.name = name
+        self.fields = fields
+        self.counters = defaultdict(float)
+
+    def add(self, **counters):
+        """ Adds to counters of the stage, e.g., add(examples=8, tokens=1024). """
+        for name, value in counters.items():
+            self.counters[name] += value
+
+    @contextmanager
+    def timed(self, name: str):
+        """ Adds the wall time of the block to counter name (e.g., 'backward_s'). """
+        _cuda_synchronize()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _cuda_synchronize()
+            self.counters[name] += time.perf_counter() - start
+
+
+class _NullStage:
+    """ Stage when tracing is off. """
+
+    def add(self, **counters):
+        pass
+
+    def timed(self, name: str):
+        return nullcontext()
+
+
+_NULL_STAGE = _NullStage()
+
+
+@contextmanager
+def stage(name: str, **fields):
+    """ Traces the wall/cpu time, peak memory and counters of the block as stage name (nested stages record their parent). """
+    if _trace_path is None:
+        yield _NULL_STAGE
+        return
+    stack = _local.__dict__.setdefault('stack', [])
+    current = Stage(name, fields)
+    parent = stack[-1].id if stack else None
+    stack.append(current)
+    error = None
+    _cuda_synchronize()
+    start, wall_start, cpu_start = time.time(), time.perf_counter(), time.process_time()
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        _cuda_synchronize()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        stack.pop()
+        _write({'stage': name, 'id': current.id, 'parent': parent, 'depth': len(stack), 'pid': os.getpid(),
+                'thread': threading.current_thread().name, 'start': start, 'wall_s': wall, 'cpu_s': cpu,
+                'peak_rss_mb': _peak_rss_mb(), 'error': error, **current.fields, **current.counters})
+
+
+def current_stage():
+    """ Innermost running stage of this thread (e.g., of a traced function), a no-op stage if there's none. """
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if _trace_path is not None and stack else _NULL_STAGE
+
+
+def traced(name: str = None):
+    """ Decorator tracing every call of the function as a stage (named after the function by default). """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _trace_path is None:
+                return fn(*args, **kwargs)
+            with stage(name or fn.__qualname__):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_trace(path) -> list[dict]:
+    records = []
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue  # truncated last line of a killed run
+    return records
+
+
+def summarize(records: list[dict]) -> dict[str, dict]:
+    """
+    Per stage: count, total/mean wall_s, self_s (wall time not spent in child stages of the same thread), cpu_s,
+    max peak_rss_mb and the sums of its counters (e.g., examples, tokens, forward_s), plus tokens_per_s.
+    """
+    children_wall = defaultdict(float)
+    for record in records:
+        if record.get('parent') is not None:
+            children_wall[record['parent']] += record['wall_s']
+    summary: dict[str, dict] = {}
+    base = {'stage', 'id', 'parent', 'depth', 'pid', 'thread', 'start', 'wall_s', 'cpu_s', 'peak_rss_mb', 'error'}
+    for record in records:
+        stats = summary.setdefault(record['stage'], defaultdict(float))
+        stats['count'] += 1
+        stats['wall_s'] += record['wall_s']
+        stats['self_s'] += record['wall_s'] - children_wall[record['id']]
+        stats['cpu_s'] += record['cpu_s']
+        stats['peak_rss_mb'] = max(stats['peak_rss_mb'], record['peak_rss_mb'])
+        stats['errors'] += record['error'] is not None
+        for key, value in record.items():
+            if key not in base and isinstance(value, (int, float)) and not isinstance(value, bool) and key.endswith(('_s', 'examples', 'tokens')):
+                stats[key] += value
+    for stats in summary.values():
+        stats['mean_wall_s'] = stats['wall_s'] / stats['count']
+        if stats.get('tokens'):
+            stats['tokens_per_s'] = stats['tokens'] / max(stats['wall_s'], 1e-9)
+    return {name: dict(stats) for name, stats in sorted(summary.items(), key=lambda item: -item[1]['wall_s'])}
+
+
+def print_summary(summary: dict[str, dict]):
+    columns = ['count', 'wall_s', 'self_s', 'mean_wall_s', 'cpu_s', 'peak_rss_mb', 'examples', 'tokens', 'tokens_per_s']
+    print(f'{"stage":<36}' + ''.join(f'{column:>14}' for column in columns))
+    for name, stats in summary.items():
+        print(f'{name:<36}' + ''.join(f'{stats.get(column, float("nan")):>14.6g}' for column in columns))
+        # timings inside the stage, e.g., forward_s/backward_s of fine-tuning
+        for key in sorted(key for key in stats if key.endswith('_s') and key not in columns):
+            print(f'    {key:<32}{stats[key]:>14.6g}  ({stats[key] / max(stats["wall_s"], 1e-9):.0%} of the stage)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Summarize a diversity pipeline trace (see diversity.profiling).')
+    parser.add_argument('trace', type=str, help='JSON lines trace written with DIVERSITY_TRACE=trace.jsonl.')
+    parser.add_argument('--json', action='store_true', help='Print the summary as json.')
+    args = parser.parse_args()
+    summary = summarize(read_trace(args.trace))
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_summary(summary)
+
+# -- Tests, examples
+
+def test_profiling():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'trace.jsonl')
+        enable_tracing(path)
+        @traced('inner')
+        def inner():
+            with current_stage().timed('sleep_s'):
+                time.sleep(0.05)
+            current_stage().add(examples=4, tokens=100)
+
+        with stage('outer', run='test') as outer:
+            for _ in range(2):
+                inner()
+            outer.add(examples=8)
+        disable_tracing()
+        with stage('not_traced'):
+            pass
+        records = read_trace(path)
+        assert [r['stage'] for r in records] == ['inner', 'inner', 'outer'] and records[0]['parent'] == records[2]['id']
+        summary = summarize(records)
+        print_summary(summary)
+        assert summary['inner']['count'] == 2 and summary['inner']['tokens'] == 200 and summary['inner']['sleep_s'] >= 0.1
+        assert summary['outer']['self_s'] < summary['outer']['wall_s'] - 0.1 and records[2]['run'] == 'test'
+    print('Success!')
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main()
+    else:
+        test_profiling()
@@ -0,0 +1,37 @@
+#!/bin/bash
+# Sharded run: start this same script on every host (e.g., one job per GPU node) with OUTPUT_DIR on a shared file system.
+# Hosts claim shards of SHARD_SIZE tasks from the ledger in OUTPUT_DIR/ledger until none are left, the shards of killed
+# hosts are claimed again after STALE_AFTER seconds. Once all shards are done the merge step (cheap, runs on one host)
+# computes the distance matrix and div coeff: `python main.py ... --merge`.
+
+chmod +x *.sh
+chmod +x ./scripts/*.sh
+
+export CUDA_VISIBLE_DEVICES=0
+
+DATASET=c4
+NUM_TASKS=600
+SHARD_SIZE=25
+STALE_AFTER=900
+BATCH_SIZE=512
+BUFFER_SIZE=500000
+OUTPUT_DIR="../div-output"
+CACHE_DIR="../cache_dir"
+
+for DATASET in c4 wikitext the_pile
+do
+python main.py \
+    --task_name $DATASET \
+    --num_tasks $NUM_TASKS \
+    --batch_size $BATCH_SIZE \
+    --buffer_size $BUFFER_SIZE \
+    --finetune \
+    --pretrained \
+    --shard_size $SHARD_SIZE \
+    --stale_after $STALE_AFTER \
+    --output_dir ${OUTPUT_DIR}/output_${DATASET}_${NUM_TASKS}tasks_bs${BATCH_SIZE}_gpt2_pt_ft \
+    --cache_dir $CACHE_DIR
+done
+
+# on one host, once all shards are done:
+# python main.py --task_name $DATASET --num_tasks $NUM_TASKS --merge --output_dir ...
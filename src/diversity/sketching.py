@@ -0,0 +1,84 @@
+"""
+Seeded sparse Johnson-Lindenstrauss sketches of Task2Vec embeddings.
+
+The hessian of an (autoregressive) embedding has one entry per filter of every module of the probe network, far more
+dimensions than estimating distances needs. A sketch S x of dim << len(x) entries preserves inner products (so norms and
+cosines) up to a small error with high probability. The projection is a sparse JL transform (each input coordinate
+goes to nnz random output coordinates with random signs, scaled by 1 / sqrt(nnz)), so it costs O(nnz * len(x)) to apply
+and is never materialized as a dense [dim, len(x)] matrix. It only depends on (len(x), dim, seed, nnz), so sketches made
+with the same sketch_opts (e.g., in different runs or processes) are comparable.
+
+Note: only distances that are functions of inner products of the vectors themselves can be computed on sketches, e.g.,
+'hessian_cosine' (see task_similarity), not the default Task2Vec 'cosine' that rescales each pair by h0 + h1 first.
+"""
+import functools
+import math
+
+import numpy as np
+
+
+@functools.lru_cache(maxsize=4)
+def _sparse_projection(input_dim: int, dim: int, seed: int, nnz: int) -> tuple[np.ndarray, np.ndarray]:
+    """ Output coordinates [nnz, input_dim] and signs [nnz, input_dim] of the sparse JL transform. """
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, dim, size=(nnz, input_dim), dtype=np.int32)
+    signs = rng.integers(0, 2, size=(nnz, input_dim), dtype=np.int8) * 2 - 1
+    return rows, signs.astype(np.int8)
+
+
+def sketch(x: np.ndarray, dim: int = 4096, seed: int = 0, nnz: int = 8) -> np.ndarray:
+    """ Sparse JL sketch of the vector x as a float32 vector of dim entries. """
+    x = np.asarray(x, dtype=np.float64).reshape(-1)
+    rows, signs = _sparse_projection(len(x), dim, seed, nnz)
+    sketched = np.zeros(dim)
+    for k in range(nnz):
+        sketched += np.bincount(rows[k], weights=signs[k] * x, minlength=dim)
+    return (sketched / math.sqrt(nnz)).astype(np.float32)
+
+
+def sketch_embedding(embedding, dim: int = 4096, seed: int = 0, nnz: int = 8, keep_full: bool = True):
+    """
+    Adds the sketch of embedding.hessian to embedding (embedding.sketch), e.g., sketch_opts={'dim': 4096, 'seed': 0}
+    in Task2Vec. Without keep_full the full hessian/scale are dropped (only the sketch is kept).
+    """
+    embedding.sketch = sketch(embedding.hessian, dim=dim, seed=seed, nnz=nnz)
+    embedding.meta = {**(embedding.meta or {}), 'sketch': {'dim': dim, 'seed': seed, 'nnz': nnz}}
+    if not keep_full:
+        embedding.hessian, embedding.scale = None, None
+    return embedding
+
+
+def jl_error_bound(dim: int, num_pairs: int = 1, delta: float = 0.05) -> float:
+    """
+    Bound on |cosine distance of the sketches - cosine distance of the vectors| that holds for num_pairs pairs at once
+    with probability >= 1 - delta, for a JL transform that preserves the norm of any fixed vector up to a factor
+    1 +- eps with probability >= 1 - 2 exp(-dim eps^2 / 8), i.e., a dense Gaussian projection. The sketches here are
+    sparse (nnz = 8 by default), for which the sparse JL guarantees (Kane & Nelson) have the same eps ~ sqrt(log(1 / delta)
+    / dim) rate but other (unspecified) constants and also need nnz ~ eps dim, so this is only the dense reference,
+    not a guarantee for sketch(): check the measured error with sketch_distance_error in task_similarity.
+
+    It bounds the error of 'sketch_cosine' against 'hessian_cosine' (the cosine of the hessians themselves), not against
+    the default Task2Vec 'cosine' (which rescales each pair by h0 + h1), so don't compare div coeffs of sketched
+    embeddings with 'cosine' ones.
+
+    By polarization <Su, Sv> is within eps of <u, v> for unit u, v once u +- v and u, v keep their norms (4 vectors per
+    pair), so the cosine is within 2 eps / (1 - eps). Returns inf if dim is too small for a bound below 1.
+    """
+    eps = math.sqrt(8 * math.log(8 * num_pairs / delta) / dim)
+    return 2 * eps / (1 - eps) if eps < 1 else float('inf')
+
+# -- Tests, examples
+
+def test_sketch():
+    rng = np.random.default_rng(0)
+    x, y = rng.random(100_000), rng.random(100_000)
+    sx, sy = sketch(x, dim=4096, seed=1), sketch(y, dim=4096, seed=1)
+    assert np.array_equal(sx, sketch(x, dim=4096, seed=1)), 'Err: sketch is not deterministic given a seed'
+    exact = 1 - x @ y / np.linalg.norm(x) / np.linalg.norm(y)
+    approx = 1 - sx @ sy / np.linalg.norm(sx) / np.linalg.norm(sy)
+    print(f'{exact=} {approx=} bound={jl_error_bound(4096)}')
+    assert abs(exact - approx) <= jl_error_bound(4096)
+    print('Success!')
+
+if __name__ == '__main__':
+    test_sketch()
@@ -12,8 +12,12 @@
 # language governing permissions and limitations under the License.
 
 import itertools
+import json
 import math
+import os
 import random
+import re
+import time
 from abc import ABC, abstractmethod
 
 from copy import deepcopy
@@ -25,9 +29,11 @@ from torch.optim import Optimizer
 import numpy as np
 from tqdm.auto import tqdm, trange
 import logging
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, BatchSampler, SequentialSampler
 
 from diversity.utils import AverageMeter, get_error, get_device
+from diversity.sketching import sketch_embedding
+from diversity.profiling import stage, traced, current_stage
 
 ## LLM DIV
 def set_seed(seed):
@@ -36,6 +42,11 @@ def set_seed(seed):
     torch.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
+## LLM DIV
+# label of the positions no loss/Fisher term predicts (padding, document starts when packing), as in HF transformers.
+# Not the pad token: GPT-2 pads with its EOS token, so masking by token value would also drop the real EOS tokens.
+IGNORE_INDEX = -100
+
 ## LLM DIV
 def get_loss(logits: torch.tensor, targets: torch.tensor, ignore_index=None) -> torch.tensor:
     """
@@ -49,6 +60,17 @@ def get_loss(logits: torch.tensor, targets: torch.tensor, ignore_index=None) ->
        
     return loss(logits, targets)
 
+## LLM DIV
+def sample_categorical(logits: torch.tensor, generator: torch.Generator = None) -> torch.tensor:
+    """
+    Samples y ~ softmax(logits) independently at every position of logits [..., V] with the Gumbel-max trick,
+    argmax(logits + G) with G = -log(-log(U)), U ~ Uniform[0, 1), which has exactly the softmax distribution. It's one
+    batched op over all positions (instead of a torch.multinomial per sequence) and never materializes the softmax.
+    note: torch.rand + log is several times faster on cpu than Tensor.exponential_.
+    """
+    noise = torch.rand(logits.shape, generator=generator, dtype=torch.float32, device=logits.device)
+    return noise.log_().neg_().log_().neg_().add_(logits.detach()).argmax(dim=-1)
+
 class Embedding:
     """
     task_embedding = diagonal of the FIM for the filters of size [F_total, 1] total filters for a network.
@@ -56,15 +78,231 @@ class Embedding:
     Notes:
         - the diagonal of the Fisher Information Matrix for each layer.
         - embedding size should be the size of the total number of filters for the network.
+        - (LLM DIV) slotted, stored in dtype (default: the dtype it's given, e.g., float32 for autoregressive ones, float16
+        halves it again but values below ~6e-8 underflow to 0). A scale that is all ones (always the case in autoregressive
+        mode) is kept as a scalar and `scale` returns a read-only broadcast view of it. meta['layers'] has the name/offset/size
+        of every layer in the hessian. save/load and save_embeddings/load_embeddings use .npz/.npy (no pickle).
     """
+    __slots__ = ('hessian', '_scale', 'meta', 'sketch')
 
-    def __init__(self, hessian, scale, meta=None):
-        self.hessian = np.array(hessian)
-        self.scale = np.array(scale)
+    def __init__(self, hessian, scale=None, meta=None, sketch=None, dtype=None):
+        self.hessian = None if hessian is None else np.asarray(hessian, dtype=dtype)
+        self.scale = scale
         self.meta = meta
+        self.sketch = sketch  # random projection of the hessian, see diversity.sketching
+
+    @property
+    def scale(self):
+        if self.hessian is None:
+            return None
+        return self._scale if self._scale.ndim > 0 else np.broadcast_to(self._scale, self.hessian.shape)
+
+    @scale.setter
+    def scale(self, scale):
+        dtype = np.float32 if self.hessian is None else self.hessian.dtype
+        scale = np.asarray(1.0 if scale is None else scale, dtype=dtype)
+        self._scale = np.ones((), dtype=dtype) if np.all(scale == 1) else scale
+
+    def astype(self, dtype) -> 'Embedding':
+        scale = self._scale if self._scale.ndim > 0 else None
+        return Embedding(self.hessian, scale, meta=self.meta, sketch=self.sketch, dtype=dtype)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(x.nbytes for x in (self.hessian, self._scale, self.sketch) if x is not None)
+
+    def __getstate__(self):
+        return {'hessian': self.hessian, 'scale': self._scale, 'meta': self.meta, 'sketch': self.sketch}
+
+    def __setstate__(self, state):
+        # also loads pickles of the plain (unslotted) Embedding, i.e., its __dict__ without sketch
+        self.hessian = state['hessian']
+        self.scale = state.get('scale')
+        self.meta = state.get('meta')
+        self.sketch = state.get('sketch')
 
     def __repr__(self):
-        return f'{self.hessian}'
+        return f'{self.hessian if self.hessian is not None else self.sketch}'
+
+    def _arrays(self) -> dict:
+        arrays = {'hessian': self.hessian, 'scale': self._scale if self._scale.ndim > 0 else None, 'sketch': self.sketch}
+        return {name: array for name, array in arrays.items() if array is not None}
+
+    def save(self, path):
+        """ Saves to a .npz file (meta as json), see load. """
+        np.savez(path, meta=np.array(json.dumps(self.meta, default=_json_default)), **self._arrays())
+
+    @classmethod
+    def load(cls, path) -> 'Embedding':
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data['hessian'] if 'hessian' in data else None, data['scale'] if 'scale' in data else None,
+                       meta=json.loads(str(data['meta'])), sketch=data['sketch'] if 'sketch' in data else None)
+
+
+def _json_default(x):
+    return x.item() if hasattr(x, 'item') else str(x)
+
+
+def save_embeddings(embeddings: list, path):
+    """
+    Saves embeddings of the same size to the directory path as stacked [n, d] .npy arrays (hessians, plus scales and
+    sketches if they have any) and meta.json, so load_embeddings can memory map them. Scales are saved if any embedding
+    has one (the all ones scale of the others is saved as is), a hessian or sketch only some of them have is an error.
+    """
+    stacked = {}
+    for name in ('hessian', 'scale', 'sketch'):
+        arrays = [e._arrays().get(name) for e in embeddings]
+        missing = [i for i, array in enumerate(arrays) if array is None]
+        if len(missing) == len(arrays):
+            continue
+        if name == 'scale':
+            arrays = [e.scale for e in embeddings]
+        elif len(missing) > 0:
+            raise ValueError(f'Only some embeddings have a {name}, e.g., embeddings {missing[:5]} have none')
+        stacked[name] = np.stack(arrays)
+    os.makedirs(path, exist_ok=True)
+    for name, array in stacked.items():
+        np.save(os.path.join(path, name + 's.npy'), array)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump([e.meta for e in embeddings], f, default=_json_default)
+
+
+def load_embeddings(path, mmap_mode='r') -> list:
+    """ Embeddings saved by save_embeddings, with mmap_mode their arrays are views of memory mapped files (zero copy). """
+    with open(os.path.join(path, 'meta.json')) as f:
+        metas = json.load(f)
+    arrays = {}
+    for name in ('hessian', 'scale', 'sketch'):
+        file = os.path.join(path, name + 's.npy')
+        arrays[name] = np.load(file, mmap_mode=mmap_mode) if os.path.exists(file) else [None] * len(metas)
+    return [Embedding(hessian, scale, meta=meta, sketch=sketch)
+            for hessian, scale, sketch, meta in zip(arrays['hessian'], arrays['scale'], arrays['sketch'], metas)]
+
+
+## LLM DIV
+class MaterializedBatch(Dataset):
+    """
+    In-memory store of a tokenized batch (i.e., one Task2Vec task) as compact tensors.
+
+    Streaming HF datasets re-run the shuffle buffer and the tokenizer every time they are iterated, so the batch is
+    pulled once into `input_ids` (int32) / `attention_mask` (bool) / `labels` (int32) tensors and every fine-tuning
+    epoch and the Fisher pass index into them. Indexing with a list or slice returns a whole mini-batch (as long tensors,
+    what the model expects) so the data loader does not need to collate example by example. With trim_padding the
+    mini-batch is cut to its longest real sequence, so padding="max_length" doesn't cost forward/backward compute
+    (`padded_positions` of a mini-batch is its number of positions before the cut).
+    `labels` is input_ids with IGNORE_INDEX at the positions that shouldn't be predicted (padding, document starts), by
+    default the positions the attention mask drops.
+    """
+
+    def __init__(self, input_ids: torch.Tensor, attention_mask: torch.Tensor = None, labels: torch.Tensor = None,
+                 trim_padding: bool = True):
+        assert input_ids.dim() == 2, f'Err: expected [num_examples, seq_len] input_ids but got {input_ids.shape=}'
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids, dtype=torch.bool)
+        if labels is None:
+            labels = input_ids.masked_fill(~attention_mask.to(torch.bool), IGNORE_INDEX)
+        compact_dtype = torch.int32 if input_ids.numel() == 0 or input_ids.max() < 2**31 else torch.long
+        self.input_ids = input_ids.to(compact_dtype).contiguous()
+        self.attention_mask = attention_mask.to(torch.bool).contiguous()
+        self.labels = labels.to(compact_dtype).contiguous()
+        self.trim_padding = trim_padding
+
+    def __len__(self):
+        return self.input_ids.shape[0]
+
+    def __getitem__(self, index):
+        input_ids, attention_mask, labels = self.input_ids[index], self.attention_mask[index], self.labels[index]
+        padded_positions = input_ids.numel()
+        if self.trim_padding and attention_mask.dim() == 2:
+            # drop the columns after the longest real sequence of the mini-batch (they are padding in every row)
+            real_positions = attention_mask.any(dim=0).nonzero()
+            length = int(real_positions.max()) + 1 if len(real_positions) > 0 else 1
+            input_ids, attention_mask, labels = input_ids[:, :length], attention_mask[:, :length], labels[:, :length]
+        return {'input_ids': input_ids.long(), 'attention_mask': attention_mask.long(), 'labels': labels.long(),
+                'padded_positions': padded_positions}
+
+
+## LLM DIV
+def materialize_batch(dataset, pad_token_id: int = 50256, trim_padding: bool = True, pack: bool = False,
+                      pack_length: int = None) -> MaterializedBatch:
+    """
+    Iterates the (tokenized) dataset exactly once and stores it as a `MaterializedBatch`.
+
+    Sequences of different lengths (e.g., tokenized without padding="max_length") are right padded with pad_token_id
+    and masked out in the attention mask. With pack the real tokens of all sequences are packed into rows of
+    pack_length tokens instead (see pack_documents).
+    """
+    if isinstance(dataset, MaterializedBatch):
+        return dataset
+    input_ids, attention_masks = [], []
+    for example in dataset:
+        ids = torch.as_tensor(example['input_ids']).view(-1)
+        input_ids.append(ids)
+        if 'attention_mask' in example:
+            attention_masks.append(torch.as_tensor(example['attention_mask']).view(-1).to(torch.bool))
+        else:
+            attention_masks.append(torch.ones_like(ids, dtype=torch.bool))
+    assert len(input_ids) > 0, f'Err: the batch to materialize is empty {dataset=}'
+    input_ids = nn.utils.rnn.pad_sequence(input_ids, batch_first=True, padding_value=pad_token_id)
+    attention_mask = nn.utils.rnn.pad_sequence(attention_masks, batch_first=True, padding_value=False)
+    if pack:
+        return pack_documents(input_ids, attention_mask, pad_token_id=pad_token_id, pack_length=pack_length, trim_padding=trim_padding)
+    return MaterializedBatch(input_ids, attention_mask, trim_padding=trim_padding)
+
+
+## LLM DIV
+def pack_documents(input_ids: torch.Tensor, attention_mask: torch.Tensor, pad_token_id: int = 50256,
+                   pack_length: int = None, trim_padding: bool = True) -> MaterializedBatch:
+    """
+    Concatenates the real (attention_mask == 1) tokens of every sequence and cuts them into rows of pack_length tokens
+    (default: the padded length of the batch), like group_texts but keeping track of the document boundaries. The first
+    token of every document (and the padding) gets IGNORE_INDEX in `labels` so no loss/Fisher term predicts a document
+    from the end of the previous one. Attention still crosses documents within a row (as with group_texts).
+    """
+    attention_mask = attention_mask.to(torch.bool)
+    pack_length = input_ids.shape[1] if pack_length is None else pack_length
+    documents = [ids[mask] for ids, mask in zip(input_ids, attention_mask)]
+    stream = torch.cat(documents)
+    document_starts = torch.zeros(len(stream), dtype=torch.bool)
+    offsets = torch.tensor([0] + [len(document) for document in documents]).cumsum(dim=0)[:-1]
+    document_starts[offsets[offsets < len(stream)]] = True
+    num_rows = max(math.ceil(len(stream) / pack_length), 1)
+    num_pad = num_rows * pack_length - len(stream)
+    packed_ids = torch.cat([stream, stream.new_full((num_pad,), pad_token_id)]).view(num_rows, pack_length)
+    packed_mask = torch.cat([torch.ones(len(stream), dtype=torch.bool), torch.zeros(num_pad, dtype=torch.bool)]).view(num_rows, pack_length)
+    ignore = torch.cat([document_starts, torch.ones(num_pad, dtype=torch.bool)]).view(num_rows, pack_length)
+    labels = packed_ids.masked_fill(ignore, IGNORE_INDEX)
+    print(f'Packed {len(documents)} sequences ({input_ids.numel()} positions) into {num_rows} rows of {pack_length=} ({len(stream)} real tokens)')
+    return MaterializedBatch(packed_ids, packed_mask, labels=labels, trim_padding=trim_padding)
+
+
+## LLM DIV
+def _labels_of(batch: dict) -> torch.Tensor:
+    """ Labels of a mini-batch, for batches without labels (not materialized) input_ids with the padding ignored. """
+    if 'labels' in batch:
+        return batch['labels']
+    return batch['input_ids'].masked_fill(batch['attention_mask'] == 0, IGNORE_INDEX)
+
+
+## LLM DIV
+def _get_batch_loader(dataset: Dataset, loader_opts: dict) -> DataLoader:
+    """ Data loader over the examples of a task in order, slicing whole mini-batches out of a MaterializedBatch. """
+    batch_size = loader_opts.get('batch_size', 8)
+    if isinstance(dataset, MaterializedBatch):
+        # No need for mutli-threaded loading since everything is already in memory
+        sampler = BatchSampler(SequentialSampler(dataset), batch_size=batch_size, drop_last=False)
+        return DataLoader(dataset, sampler=sampler, batch_size=None)
+    return DataLoader(dataset, shuffle=False, batch_size=batch_size,
+                      num_workers=loader_opts.get('num_workers', 0), drop_last=False)
+
+
+## LLM DIV
+def _num_batches(data_loader: DataLoader) -> int:
+    try:
+        return len(data_loader)
+    except TypeError:
+        # not ideal but it's quicker in dev time, usually we won't feed the entire data set to task2vec so this should be fine
+        return len(list(data_loader))
 
 
 class ProbeNetwork(ABC, nn.Module):
@@ -90,7 +328,8 @@ class ProbeNetwork(ABC, nn.Module):
 class Task2Vec:
 
     def __init__(self, model: ProbeNetwork, skip_layers=0, max_samples=None, classifier_opts=None,
-                 method='montecarlo', method_opts=None, loader_opts=None, bernoulli=False, mode='autoregressive', _deep_copy: bool = True): ## LLM DIV
+                 method='montecarlo', method_opts=None, loader_opts=None, bernoulli=False, mode='autoregressive', _deep_copy: bool = True,
+                 layer_opts=None, sketch_opts=None): ## LLM DIV
         if classifier_opts is None:
             classifier_opts = {}
         if method_opts is None:
@@ -112,12 +351,17 @@ class Task2Vec:
         self.loader_opts = loader_opts
         self.bernoulli = bernoulli
         self.mode = mode
+        self.layer_opts = layer_opts  # which layers the (autoregressive) embedding covers, see select_fisher_modules
+        self.sketch_opts = sketch_opts  # e.g., {'dim': 4096, 'seed': 0, 'keep_full': True}, see diversity.sketching
+        self.fisher_accumulator = None  # autoregressive montecarlo Fisher, created lazily (or handed in by a ProbeSession)
+        self.fisher_meta = None
         if self.mode == "autoregressive":
             self.loss_fn = get_loss
         else:
             self.loss_fn = nn.CrossEntropyLoss() if not self.bernoulli else nn.BCEWithLogitsLoss()
             self.loss_fn = self.loss_fn.to(self.device)
 
+    @traced('Task2Vec.embed')
     def embed(self, dataset: Dataset, epochs: int = 5):
         ## LLM DIV
         # Cache the last layer features (needed to train the classifier) and (if needed) the intermediate layer features
@@ -126,6 +370,11 @@ class Task2Vec:
         if self.mode == "autoregressive":
             loss = None
             print(f'{self.classifier_opts=}')
+            if self.loader_opts.get('materialize', True):
+                # pull the (streaming) batch once and reuse it for every fine-tuning epoch and the Fisher pass
+                with stage('materialize_batch'):
+                    dataset = materialize_batch(dataset, trim_padding=self.loader_opts.get('trim_padding', True),
+                                                pack=self.loader_opts.get('pack', False), pack_length=self.loader_opts.get('pack_length'))
             if self.classifier_opts:  # is it something truthy? e.g., dict with something in it?
                 if self.classifier_opts.get('finetune', False):  # finetune only if specified True, else no finetuning if not specified or False. 
                     epochs = 0
@@ -139,6 +388,8 @@ class Task2Vec:
             assert loss is not None, f'Err: {loss=}'
             self.compute_fisher(dataset)
             embedding = self.extract_embedding(self.model)
+            if self.sketch_opts:
+                sketch_embedding(embedding, **self.sketch_opts)
             return embedding, loss
         else:
             if self.skip_layers > 0:
@@ -160,6 +411,7 @@ class Task2Vec:
             return embedding
         
     ### LLM DIV 
+    @traced('finetune_classifier')
     def _finetune_classifier(self, dataset: Dataset, loader_opts: dict = None, classifier_opts: dict = None, max_samples=None, epochs = 5, learning_rate = 5e-5, adam_epsilon = 1e-8):
         """Fits the last layer of the HuggingFace transformer probe network."""
         logging.info("Finetune classifier...")
@@ -167,14 +419,17 @@ class Task2Vec:
             loader_opts = {}
         if classifier_opts is None:
             classifier_opts = {}
-        data_loader = DataLoader(dataset, shuffle=False, batch_size=loader_opts.get('batch_size', 8),
-                                 num_workers=loader_opts.get('num_workers', 0), drop_last=False)
+        if classifier_opts.get('cached_trunk', False):
+            # only lm_head is trained, so run the transformer once and fit lm_head on its cached final hidden states
+            self._cache_features_autoregressive(dataset, loader_opts=loader_opts)
+            return self._fit_classifier_autoregressive(classifier_opts=classifier_opts, epochs=epochs, learning_rate=learning_rate, adam_epsilon=adam_epsilon)
+        data_loader = _get_batch_loader(dataset, loader_opts)
 
         device = next(self.model.parameters()).device
         print("MODEL DEVICE: ", device)
         
         # num_examples = int(classifier_opts.get("task_batch_size", 256) / loader_opts.get('batch_size', 8))
-        num_examples = len(list(data_loader))  # not ideal but it's quicker in dev time, usually we won't feed the entire data set to task2vec so this should be fine
+        num_examples = _num_batches(data_loader)
         n_batches = num_examples
         
         optimizer_grouped_parameters = [
@@ -195,6 +450,7 @@ class Task2Vec:
         
         self.model.train()
         step, epoch, loss = None, None, torch.tensor(-1.0)
+        num_tokens, start = 0, time.time()
         for epoch in train_iterator:
             metrics = AverageMeter()
             epoch_iterator = tqdm(data_loader, desc="Iteration", total=n_batches, leave=False)
@@ -202,15 +458,20 @@ class Task2Vec:
                 optimizer.zero_grad()
                 inputs = {'input_ids': batch['input_ids'].to(device),
                         'attention_mask': batch['attention_mask'].to(device)}
-                logits = self.model(**inputs, labels=inputs["input_ids"]).logits
-                loss = self.loss_fn(logits, inputs["input_ids"], ignore_index=50256)
+                labels = _labels_of(batch).to(device)
+                with current_stage().timed('forward_s'):
+                    logits = self.model(**inputs, labels=inputs["input_ids"]).logits
+                    loss = self.loss_fn(logits, labels, ignore_index=IGNORE_INDEX)
                 print(f'\nInitial loss {loss.item()} ({step=} {epoch=})') if step == 0 else None
-                error = get_error(logits, inputs['input_ids'], ignore_index=50256)
-                loss.backward()
-                optimizer.step()
+                error = get_error(logits, labels, ignore_index=IGNORE_INDEX)
+                with current_stage().timed('backward_s'):
+                    loss.backward()
+                    optimizer.step()
                 
                 metrics.update(n=batch['input_ids'].shape[0], loss=loss.item(), error=error)
                 epoch_iterator.update(1)
+                num_tokens += int(batch['attention_mask'].sum())
+                current_stage().add(examples=batch['input_ids'].shape[0], tokens=int(batch['attention_mask'].sum()))
                 
                 if classifier_opts.get("break_early", False):
                     print("----> breaking early")
@@ -218,29 +479,112 @@ class Task2Vec:
             if classifier_opts.get("break_early", False):
                 break
             logging.info(f"[epoch {epoch}]: " + "\t".join(f"{k}: {v}" for k, v in metrics.avg.items()))
+        print(f'Fine-tuning: {num_tokens=} tokens/s={num_tokens / max(time.time() - start, 1e-9):.1f}')
+        print(f'\nfinal loss {step=} {epoch=} of final layer loss {loss.item()} (note we are not recomputing loss after a step so this loss printed is larger than it should be/one off)')
+        return loss.item()
+
+    ### LLM DIV
+    @traced('cache_features')
+    def _cache_features_autoregressive(self, dataset: Dataset, loader_opts: dict = None):
+        """
+        Caches the final hidden states of the transformer trunk (i.e., the input features of lm_head) for every
+        mini-batch of the task, the autoregressive analogue of `_cache_features`.
+
+        Note: GPT-2 ties lm_head to the input token embeddings, so while fitting lm_head on the cached features the
+        trunk (unlike in the full forward+backward) keeps seeing the token embeddings from before fine-tuning.
+        For probes with an untied lm_head (e.g., LLaMA-2) the fit is the same as the full fine-tuning.
+        """
+        logging.info("Caching features...")
+        if loader_opts is None:
+            loader_opts = {}
+        data_loader = _get_batch_loader(dataset, loader_opts)
+        device = get_device(self.model)
+        self.cached_features = []
+        with torch.no_grad():
+            for batch in tqdm(data_loader, desc="Caching features", total=_num_batches(data_loader), leave=False):
+                input_ids, attention_mask = batch['input_ids'].to(device), batch['attention_mask'].to(device)
+                labels = _labels_of(batch).to(device)
+                hidden_states = self.model.base_model(input_ids=input_ids, attention_mask=attention_mask)[0]
+                self.cached_features.append((hidden_states, labels))
+
+    ### LLM DIV
+    @traced('fit_classifier')
+    def _fit_classifier_autoregressive(self, classifier_opts: dict = None, epochs=5, learning_rate=5e-5, adam_epsilon=1e-8):
+        """Fits lm_head using the features cached by `_cache_features_autoregressive` (one matmul over the vocab per step)."""
+        logging.info("Fitting final classifier...")
+        if not hasattr(self, 'cached_features'):
+            raise ValueError("You need to run `_cache_features_autoregressive` on model before running `_fit_classifier_autoregressive`")
+        if classifier_opts is None:
+            classifier_opts = {}
+        optimizer_grouped_parameters = [
+            {'params': [p for p in self.model.lm_head.parameters()],
+             'weight_decay': classifier_opts.get("weight_decay",0.0001)},
+        ]
+        optimizer = torch.optim.AdamW(optimizer_grouped_parameters, lr=classifier_opts.get("learning_rate",learning_rate), eps=classifier_opts.get("adam_epsilon",adam_epsilon))
+
+        train_iterator = trange(classifier_opts.get("epochs", epochs), desc="Epoch", leave=False)
+        set_seed(classifier_opts.get("seed", 42))  # Added here for reproductibility (even between python 2 and 3)
+
+        self.model.train()
+        step, epoch, loss = None, None, torch.tensor(-1.0)
+        for epoch in train_iterator:
+            metrics = AverageMeter()
+            for step, (hidden_states, labels) in enumerate(self.cached_features):
+                optimizer.zero_grad()
+                logits = self.model.lm_head(hidden_states)
+                loss = self.loss_fn(logits, labels, ignore_index=IGNORE_INDEX)
+                print(f'\nInitial loss {loss.item()} ({step=} {epoch=})') if step == 0 else None
+                error = get_error(logits, labels, ignore_index=IGNORE_INDEX)
+                loss.backward()
+                optimizer.step()
+                metrics.update(n=labels.shape[0], loss=loss.item(), error=error)
+
+                if classifier_opts.get("break_early", False):
+                    print("----> breaking early")
+                    break
+            if classifier_opts.get("break_early", False):
+                break
+            logging.info(f"[epoch {epoch}]: " + "\t".join(f"{k}: {v}" for k, v in metrics.avg.items()))
+        del self.cached_features
         print(f'\nfinal loss {step=} {epoch=} of final layer loss {loss.item()} (note we are not recomputing loss after a step so this loss printed is larger than it should be/one off)')
         return loss.item()
 
     ### LLM DIV
-    def montecarlo_fisher_autoregressive(self, dataset: Dataset, epochs: int = 1):
+    @traced('montecarlo_fisher')
+    def montecarlo_fisher_autoregressive(self, dataset: Dataset, epochs: int = 1, seed: int = None, samples_per_forward: int = 1,
+                                         tol: float = None, check_every: int = 1, metric: str = 'relative'):
+        """
+        seed (e.g., method_opts={'seed': 0}) seeds the labels sampled from the model, else the global torch rng is used.
+        samples_per_forward draws that many label sets from the logits of each forward pass and does one backward pass
+        (reusing the forward graph) for each of them, i.e., a lower variance Fisher estimate for the same forward passes.
+        If tol is given the running Fisher estimate is compared every check_every forward passes with the previous one
+        (metric='relative': ||new - old|| / ||old||, metric='cosine': cosine distance) and we stop once the change is
+        below tol, so epochs is only the budget (e.g., method_opts={'epochs': 10, 'tol': 1e-3}). The forward passes
+        used and whether it converged are reported in the embedding's meta.
+        """
+        assert metric in ('relative', 'cosine'), f'Err: unknown convergence {metric=}'
         logging.info("Using montecarlo Fisher")
         if self.loader_opts is None:
             loader_opts = {}
         else:
             loader_opts = self.loader_opts
             
-        data_loader = DataLoader(dataset, shuffle=False, batch_size=loader_opts.get('batch_size', 8),
-                                 num_workers=loader_opts.get('num_workers', 0), drop_last=False)
+        data_loader = _get_batch_loader(dataset, loader_opts)
         device = get_device(self.model)
 
         # num_examples = int(classifier_opts.get("task_batch_size", 256) / loader_opts.get('batch_size', 8))
-        num_examples = len(list(data_loader))  # not idea but it's quicker in dev time, usually we won't feed the entire data set to task2vec so this should be fine
+        num_examples = _num_batches(data_loader)
         n_batches = num_examples
 
+        generator = torch.Generator(device=device).manual_seed(seed) if seed is not None else None
+
         logging.info("Computing Fisher...")
-        for p in self.model.parameters():
-            p.grad2_acc = torch.zeros_like(p.data)
-            p.grad_counter = 0
+        if self.fisher_accumulator is None:
+            self.fisher_accumulator = FisherAccumulator(self.model, layer_opts=self.layer_opts)
+        else:
+            self.fisher_accumulator.reset()  # reuse the buffer when the probe network is shared across tasks (see ProbeSession)
+        fisher_steps, converged, last_estimate = 0, False, None
+        num_tokens, num_positions, padded_positions, start = 0, 0, 0, time.time()
             
         for k in range(epochs):
             logging.info(f"\tepoch {k + 1}/{epochs}")
@@ -249,34 +593,46 @@ class Task2Vec:
             for step, batch in enumerate(epoch_iterator):
                 inputs = {'input_ids': batch['input_ids'].to(device),
                         'attention_mask': batch['attention_mask'].to(device)}
-                logits = self.model(**inputs, labels=inputs["input_ids"]).logits
-                
-                # The gradients used to compute the FIM needs to be for y sampled from
-                # the model distribution y ~ p_w(y|x), not for y from the dataset
-                if self.bernoulli:
-                    target = torch.bernoulli(F.sigmoid(logits[:,:-1,:])).detach()
-                else:
-                    softmax_output = F.softmax(logits, dim=-1)
-                    lst = [torch.multinomial(softmax_output[i,:,:], 1).detach().view(-1) for i in range(len(softmax_output))]
-                    target = torch.stack(lst, dim=0)          
+                with current_stage().timed('forward_s'):
+                    logits = self.model(**inputs, labels=inputs["input_ids"]).logits
+                num_tokens, num_positions = num_tokens + int(batch['attention_mask'].sum()), num_positions + batch['input_ids'].numel()
+                padded_positions += batch.get('padded_positions', batch['input_ids'].numel())  # before trimming the padding
+                current_stage().add(examples=batch['input_ids'].shape[0], tokens=int(batch['attention_mask'].sum()))
                 
-                loss = self.loss_fn(logits, target, ignore_index=50256)
-                self.model.zero_grad()
-                loss.backward()
-                for p in self.model.parameters():
-                    if p.grad is not None:
-                        p.grad2_acc += p.grad.data ** 2
-                        p.grad_counter += 1
-                if self.classifier_opts.get("break_early", False):
+                for sample_num in range(samples_per_forward):
+                    # The gradients used to compute the FIM needs to be for y sampled from
+                    # the model distribution y ~ p_w(y|x), not for y from the dataset
+                    if self.bernoulli:
+                        target = torch.bernoulli(F.sigmoid(logits[:,:-1,:]), generator=generator).detach()
+                    else:
+                        target = sample_categorical(logits, generator=generator)
+                        # no Fisher terms for positions the fine-tuning ignores too (padding, document starts when packing)
+                        target = target.masked_fill(_labels_of(batch).to(device) == IGNORE_INDEX, IGNORE_INDEX)
+                    
+                    loss = self.loss_fn(logits, target, ignore_index=IGNORE_INDEX)
+                    self.model.zero_grad()
+                    with current_stage().timed('backward_s'):
+                        loss.backward(retain_graph=sample_num < samples_per_forward - 1)  # keep the graph for the next draw
+                        self.fisher_accumulator.accumulate()
+                fisher_steps += 1
+                if tol is not None and fisher_steps % check_every == 0:
+                    estimate = self.fisher_accumulator.estimate()
+                    if last_estimate is not None:
+                        change = _fisher_change(last_estimate, estimate, metric)
+                        converged = change < tol
+                        logging.info(f"\t{fisher_steps=} {metric} change={change:.3e}")
+                    last_estimate = estimate
+                if converged or self.classifier_opts.get("break_early", False):
                     break  # for debugging faster, otherwise FIM is really slow
-            if self.classifier_opts.get("break_early", False):
+            if converged or self.classifier_opts.get("break_early", False):
                 break  # for debugging faster, otherwise FIM is really slow
-        for p in self.model.parameters():
-            if p.grad_counter == 0:
-                del p.grad2_acc
-            else:
-                p.grad2_acc /= p.grad_counter
-        logging.info("done")
+        tokens_per_second = num_tokens / max(time.time() - start, 1e-9)
+        # positions the forward/backward passes computed vs. the ones they would have without trimming the padding
+        print(f'Fisher: {num_tokens=} {num_positions=} {padded_positions=} tokens/s={tokens_per_second:.1f}')
+        self.fisher_meta = {'fisher_steps': fisher_steps, 'converged': converged, 'num_tokens': num_tokens,
+                            'num_positions': num_positions, 'padded_positions': padded_positions,
+                            'tokens_per_second': tokens_per_second}
+        logging.info(f"done {self.fisher_meta}")
         
     def montecarlo_fisher(self, dataset: Dataset, epochs: int = 1):
         logging.info("Using montecarlo Fisher")
@@ -407,7 +763,23 @@ class Task2Vec:
             fisher_fn = self.montecarlo_fisher
         else:
             raise ValueError(f"Invalid Fisher method {self.method}")
-        fisher_fn(dataset, **self.method_opts)
+        if self.mode == 'autoregressive' and self.layer_opts:
+            # only the selected weights need gradients, so the backward pass stops at the first selected layer
+            weights = set(module.weight for name, module in select_fisher_modules(self.model, self.layer_opts))
+            for p in self.model.parameters():
+                if p not in weights:
+                    p.old_requires_grad = p.requires_grad
+                    p.requires_grad = False
+            try:
+                fisher_fn(dataset, **self.method_opts)
+            finally:
+                # Resets original value of requires_grad
+                for p in self.model.parameters():
+                    if hasattr(p, 'old_requires_grad'):
+                        p.requires_grad = p.old_requires_grad
+                        del p.old_requires_grad
+        else:
+            fisher_fn(dataset, **self.method_opts)
 
     def _cache_features(self, dataset: Dataset, indexes=(-1,), max_samples=None, loader_opts: dict = None):
         logging.info("Caching features...")
@@ -476,6 +848,7 @@ class Task2Vec:
             logging.info(f"[epoch {epoch}]: " + "\t".join(f"{k}: {v}" for k, v in metrics.avg.items()))
         print(f'\nfinal loss after fitting final layer {loss=}')
 
+    @traced('extract_embedding')
     def extract_embedding(self, model: ProbeNetwork):
         """
         Reads the values stored by `compute_fisher` and returns them in a common format that describes the diagonal of the
@@ -484,13 +857,15 @@ class Task2Vec:
         :param model:
         :return:
         """
-        if self.mode == 'autoregressive':
+        if self.mode == 'autoregressive' and self.fisher_accumulator is not None:
+            hessian = self.fisher_accumulator.hessian()
+            meta = {**(self.fisher_meta or {}), 'layers': self.fisher_accumulator.layers()}
+            return Embedding(hessian=hessian, scale=None, meta=meta)
+        elif self.mode == 'autoregressive':
             hess, scale = [], []
-            for name, module in model.named_modules():
-                if module is model.lm_head:
-                    continue
+            for name, module in select_fisher_modules(model, self.layer_opts):
                 # The other Fisher approximation methods directly approximate the hessian at the minimum
-                if hasattr(module, 'weight') and hasattr(module.weight, 'grad2_acc'):
+                if hasattr(module.weight, 'grad2_acc'):
                     grad2 = module.weight.grad2_acc.cpu().detach().numpy()
                     filterwise_hess = grad2.reshape(grad2.shape[0], -1).mean(axis=1)
                     hess.append(filterwise_hess)
@@ -517,6 +892,145 @@ class Task2Vec:
         return Embedding(hessian=np.concatenate(hess), scale=np.concatenate(scale), meta=None)
 
 
+## LLM DIV
+def _fisher_change(old: torch.Tensor, new: torch.Tensor, metric: str = 'relative') -> float:
+    """ How much the running (diagonal) Fisher estimate moved between two snapshots. """
+    if metric == 'relative':
+        return ((new - old).norm() / old.norm().clamp(min=1e-30)).item()
+    else:
+        return (1 - F.cosine_similarity(old, new, dim=0, eps=1e-30)).item()
+
+
+## LLM DIV
+def select_fisher_modules(model: ProbeNetwork, layer_opts: dict = None) -> list:
+    """
+    Returns the (name, module) pairs, in named_modules order, whose weights make up the autoregressive Task2Vec embedding:
+    every module with a weight except lm_head, optionally restricted by layer_opts:
+        - last_n_blocks: only the last N transformer blocks (the entries of the largest nn.ModuleList, e.g., GPT-2's
+        transformer.h or LLaMA's model.layers) and everything after them (e.g., the final layer norm),
+        - include: list of regexes, keep only modules whose name matches one of them,
+        - exclude: list of regexes, drop modules whose name matches one of them.
+    e.g., layer_opts={'last_n_blocks': 2, 'exclude': ['ln_']}
+    """
+    layer_opts = {} if layer_opts is None else layer_opts
+    named_modules = [(name, module) for name, module in model.named_modules()
+                     if module is not model.lm_head and isinstance(getattr(module, 'weight', None), torch.Tensor)]
+    if layer_opts.get('last_n_blocks') is not None:
+        blocks = max((module for module in model.modules() if isinstance(module, nn.ModuleList)), key=len)
+        first_block = blocks[max(len(blocks) - layer_opts['last_n_blocks'], 0)]
+        first_name = next(name for name, module in model.named_modules() if module is first_block)
+        names = [name for name, module in model.named_modules()]
+        cutoff = names.index(first_name)
+        named_modules = [(name, module) for name, module in named_modules if names.index(name) >= cutoff]
+    if layer_opts.get('include'):
+        named_modules = [(name, module) for name, module in named_modules if any(re.search(pattern, name) for pattern in layer_opts['include'])]
+    if layer_opts.get('exclude'):
+        named_modules = [(name, module) for name, module in named_modules if not any(re.search(pattern, name) for pattern in layer_opts['exclude'])]
+    if len(named_modules) == 0:
+        raise ValueError(f'No layers left for the Fisher embedding with {layer_opts=}')
+    return named_modules
+
+
+## LLM DIV
+class FisherAccumulator:
+    """
+    Accumulates the diagonal Fisher of an autoregressive probe network directly in the filter-wise form of its Task2Vec
+    embedding, i.e., one contiguous buffer with one entry per filter (weight.shape[0]) of every module with a weight except
+    lm_head (or only the layers selected by layer_opts, see select_fisher_modules), in the same order as extract_embedding. Since the filter-wise mean is linear, averaging the squared gradients
+    over each filter as they arrive gives the same embedding as keeping a full grad2_acc per parameter, with memory
+    proportional to the number of filters instead of the number of weights and a single copy to the cpu at the end.
+    The buffer lives on the device of the weights, so the selected modules must all be on one device (a model split
+    across devices, e.g., with device_map='auto', raises a ValueError instead of accumulating across devices).
+    """
+
+    def __init__(self, model: ProbeNetwork, layer_opts: dict = None):
+        modules = select_fisher_modules(model, layer_opts)
+        self.names = [name for name, module in modules]
+        self.weights = [module.weight for name, module in modules]
+        self.num_filters = [weight.shape[0] for weight in self.weights]
+        devices = {weight.device for weight in self.weights}
+        if len(devices) > 1:
+            raise ValueError(f'FisherAccumulator needs the Fisher modules on a single device, got {sorted(map(str, devices))}')
+        device = self.weights[0].device
+        self.buffer = torch.zeros(sum(self.num_filters), dtype=torch.float32, device=device)
+        self.filters = list(torch.split(self.buffer, self.num_filters))  # views into the buffer, one per module
+        self.counts = torch.zeros(len(self.weights), dtype=torch.float32, device=device)
+
+    def reset(self):
+        self.buffer.zero_()
+        self.counts.zero_()
+
+    @torch.no_grad()
+    def accumulate(self):
+        """ Adds the (filter-wise mean) squared gradients currently stored in the weights, call after each backward pass. """
+        for i, (weight, filters) in enumerate(zip(self.weights, self.filters)):
+            if weight.grad is not None:
+                filters += weight.grad.float().pow(2).reshape(weight.shape[0], -1).mean(dim=1)
+                self.counts[i] += 1
+
+    @torch.no_grad()
+    def estimate(self) -> torch.Tensor:
+        """ Filter-wise diagonal Fisher averaged over the steps so far (on the model's device), modules that never got a gradient are dropped. """
+        counts = torch.repeat_interleave(self.counts, torch.tensor(self.num_filters, device=self.counts.device))
+        return (self.buffer / counts.clamp(min=1))[counts > 0]
+
+    def hessian(self) -> np.ndarray:
+        return self.estimate().cpu().numpy()
+
+    def layers(self) -> list[dict]:
+        """ name/offset/size of every module in hessian() (i.e., the ones that got a gradient). """
+        layers, offset = [], 0
+        for name, num_filters, count in zip(self.names, self.num_filters, self.counts.tolist()):
+            if count > 0:
+                layers.append({'name': name, 'offset': offset, 'size': num_filters})
+                offset += num_filters
+        return layers
+
+
+## LLM DIV
+class ProbeSession:
+    """
+    Reuses one probe network for the Task2Vec embeddings of many batches instead of deep copying it for every batch.
+
+    In autoregressive mode computing an embedding only mutates the lm_head weights (fine-tuning), the gradients, the
+    Fisher accumulator and the train/eval mode of the probe network. So we snapshot the lm_head weights once and
+    restore them in place after every batch, and the session's FisherAccumulator is zeroed in place and reused by the
+    next batch. The fine-tuning optimizer is created for each batch, so its state always starts from scratch (there is no
+    optimizer state to snapshot). Peak memory stays at one probe network plus one copy of the lm_head weights.
+    layer_opts restricts the embedding to some layers for every batch (see select_fisher_modules) and sketch_opts adds a
+    random projection of it (see diversity.sketching).
+
+    embedding, loss = ProbeSession(probe_network).embed(tokenized_batch, classifier_opts={'seed': seed})
+    """
+
+    def __init__(self, model: ProbeNetwork, layer_opts: dict = None, sketch_opts: dict = None):
+        self.model = model
+        self.layer_opts = layer_opts
+        self.sketch_opts = sketch_opts
+        self.training = model.training
+        self.head_state = {name: param.detach().clone() for name, param in model.lm_head.named_parameters()}
+        self.fisher_accumulator = FisherAccumulator(model, layer_opts=layer_opts)
+
+    def restore(self):
+        """ Puts the probe network back to the state it had when the session was created. """
+        with torch.no_grad():
+            for name, param in self.model.lm_head.named_parameters():
+                param.copy_(self.head_state[name])
+        for param in self.model.parameters():
+            param.grad = None
+        self.fisher_accumulator.reset()
+        self.model.train(self.training)
+
+    def embed(self, dataset: Dataset, epochs: int = 5, **task2vec_kwargs):
+        """ Same as Task2Vec(probe_network, **task2vec_kwargs).embed(dataset, epochs) but without copying the probe network. """
+        task2vec = Task2Vec(self.model, _deep_copy=False, layer_opts=self.layer_opts, sketch_opts=self.sketch_opts, **task2vec_kwargs)
+        task2vec.fisher_accumulator = self.fisher_accumulator
+        try:
+            return task2vec.embed(dataset, epochs=epochs)
+        finally:
+            self.restore()
+
+
 def _get_loader(trainset, testset=None, batch_size=64, num_workers=0, num_samples=10000, drop_last=True):
     if getattr(trainset, 'is_multi_label', False):
         raise ValueError("Multi-label datasets not supported")
@@ -545,3 +1059,63 @@ def _get_loader(trainset, testset=None, batch_size=64, num_workers=0, num_sample
         testloader = torch.utils.data.DataLoader(testset, batch_size=batch_size, pin_memory=True, shuffle=False,
                                                  num_workers=num_workers)
         return trainloader, testloader
+
+# -- Tests, examples
+
+def test_fisher_accumulator_devices():
+    from diversity.benchmarks import tiny_probe_network
+    model = tiny_probe_network(n_layer=1)
+    accumulator = FisherAccumulator(model)
+    assert accumulator.buffer.device == model.transformer.wte.weight.device
+    model.transformer.h[0].mlp.to('meta')  # stand-in for a model split across devices
+    try:
+        FisherAccumulator(model)
+        raise AssertionError('Err: FisherAccumulator accepted modules on mixed devices')
+    except ValueError:
+        pass
+    FisherAccumulator(model, layer_opts={'exclude': [r'\.mlp\.']})  # fine if the selected modules are on one device
+    print('Success!')
+
+def test_ignore_index():
+    eos = 50256  # GPT-2 pads with its EOS token
+    dataset = [{'input_ids': [5, 6, eos, 7, eos]}, {'input_ids': [8, eos, 9]}]
+    batch = materialize_batch(dataset, pad_token_id=eos, trim_padding=False)
+    # real EOS tokens are predicted, only the padding is ignored
+    assert batch.labels.tolist() == [[5, 6, eos, 7, eos], [8, eos, 9, IGNORE_INDEX, IGNORE_INDEX]]
+    # trimming the padding of a mini-batch keeps count of the positions it had
+    trimmed = MaterializedBatch(batch.input_ids, batch.attention_mask)[[1]]
+    assert trimmed['input_ids'].shape == (1, 3) and trimmed['padded_positions'] == 5
+    packed = materialize_batch(dataset, pad_token_id=eos, trim_padding=False, pack=True, pack_length=4)
+    assert packed.input_ids.tolist() == [[5, 6, eos, 7], [eos, 8, eos, 9]]
+    assert packed.labels.tolist() == [[IGNORE_INDEX, 6, eos, 7], [eos, IGNORE_INDEX, eos, 9]]
+    # a batch that isn't materialized ignores the padding by its attention mask, not by the token value
+    raw = {'input_ids': torch.tensor([[8, eos, eos]]), 'attention_mask': torch.tensor([[1, 1, 0]])}
+    assert _labels_of(raw).tolist() == [[8, eos, IGNORE_INDEX]]
+    print('Success!')
+
+def test_save_embeddings():
+    import tempfile
+    rng = np.random.default_rng(0)
+    hessians = rng.random([3, 8]).astype(np.float32)
+    embeddings = [Embedding(hessians[0]), Embedding(hessians[1], scale=rng.random(8)), Embedding(hessians[2])]
+    with tempfile.TemporaryDirectory() as tmp:
+        # mixed scales round trip, the all ones scales stay scalars
+        save_embeddings(embeddings, tmp)
+        loaded = load_embeddings(tmp)
+        for embedding, loaded_embedding in zip(embeddings, loaded):
+            assert np.array_equal(embedding.hessian, loaded_embedding.hessian)
+            assert np.array_equal(embedding.scale, loaded_embedding.scale)
+            assert embedding._scale.ndim == loaded_embedding._scale.ndim
+        # a sketch only some embeddings have can't be saved as one array
+        embeddings[1].sketch = rng.random(4).astype(np.float32)
+        try:
+            save_embeddings(embeddings, tmp)
+            raise AssertionError('Err: saved embeddings with mixed sketches')
+        except ValueError:
+            pass
+    print('Success!')
+
+if __name__ == '__main__':
+    test_fisher_accumulator_devices()
+    test_ignore_index()
+    test_save_embeddings()
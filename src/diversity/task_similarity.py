@@ -13,14 +13,16 @@
 # ANY KIND, either express or implied. See the License for the specific
 # language governing permissions and limitations under the License.
 
-import itertools
 from typing import Tuple
 
 import scipy.spatial.distance as distance
+from scipy.spatial.distance import squareform
 import numpy as np
 import copy
 import pickle
 
+from diversity.profiling import traced, current_stage
+
 # import uutils
 
 _DISTANCES = {}
@@ -166,6 +168,24 @@ def entropy(e0, e1):
     return np.log(2) - binary_entropy(h1).mean()
 
 
+## LLM DIV
+def get_sketch(e):
+    if getattr(e, 'sketch', None) is None:
+        raise ValueError('Embedding has no sketch, compute it with sketch_opts (see diversity.sketching)')
+    return np.array(e.sketch)
+
+
+@_register_distance
+def hessian_cosine(e0, e1):
+    # cosine of the hessians themselves (no per pair rescaling), the distance sketch_cosine approximates
+    return distance.cosine(get_hessian(e0), get_hessian(e1))
+
+
+@_register_distance
+def sketch_cosine(e0, e1):
+    return distance.cosine(get_sketch(e0), get_sketch(e1))
+
+
 def get_normalized_embeddings(embeddings, normalization=None):
     F = [1. / get_variance(e, normalized=False) if e is not None else None for e in embeddings]
     zero_embedding = np.zeros_like([x for x in F if x is not None][0])
@@ -177,53 +197,259 @@ def get_normalized_embeddings(embeddings, normalization=None):
     return F, normalization
 
 
-def pdist(embeddings, distance='cosine') -> np.ndarray:
-    distance_fn = _DISTANCES[distance]
-    n = len(embeddings)
-    distance_matrix = np.zeros([n, n])
+## LLM DIV
+# Vectorized versions of the distances above: they compare stacked [n, d] embedding features a block of rows at a time
+# instead of calling the scalar distance for every pair in python. Each entry is (features of an embedding, kernel
+# comparing the rows of X [n1, d] with a block of rows Y [b, d] -> [n1, b], number of [b, d] temporaries the kernel
+# needs, used to size the block to the memory budget, function preparing the rows of X/Y for the kernel). Row i of X only
+# needs the columns from starts[i] on (e.g., pdist only compares each pair once), kernels may compute more (they are
+# ignored). Kernels compute in the dtype of the embeddings, like the scalar distances do (i.e., float32 for the
+# autoregressive embeddings). The prepare function (e.g., scaling/centering rows and their norms) runs once on all of X
+# but per block on Y (its temporaries count in num_temporaries), and kernels get what it returns.
+_PAIRWISE_DISTANCES = {}
+# bytes of temporaries a block may use, the kernels are memory bound so blocks that stay in cache are faster than bigger ones
+MEMORY_BUDGET = 2 ** 23
+
+
+def _register_pairwise_distance(name, features_fn, num_temporaries=4, prepare_fn=None):
+    def register(kernel_fn):
+        _PAIRWISE_DISTANCES[name] = (features_fn, kernel_fn, num_temporaries, prepare_fn or (lambda X: X))
+        return kernel_fn
+    return register
+
+
+def _take_rows(prepared, start, end):
+    # rows [start, end) of prepared features, an array or a tuple of row aligned arrays
+    return tuple(a[start:end] for a in prepared) if isinstance(prepared, tuple) else prepared[start:end]
+
+
+def _cosine_from_dots(uv, uu, vv):
+    # same as scipy.spatial.distance.cosine/correlation given the dot products
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(1.0 - uv / np.sqrt(uu * vv), 0.0, 2.0)
+
+
+@_register_pairwise_distance('cosine', get_hessian)
+def _cosine_kernel(X, Y, starts):
+    # cosine between the scaled hessians h0 / (h0 + h1 + 1e-8) and h1 / (h0 + h1 + 1e-8), with w = 1 / (h0 + h1 + 1e-8)^2:
+    # uv = sum h0 h1 w, uu = sum h0^2 w, vv = sum h1^2 w, i.e., two matrix-vector products and one row-wise dot per row
+    distances = np.zeros([len(X), len(Y)])
+    for i, (x, start) in enumerate(zip(X, starts)):
+        Y_i = Y[start:]
+        w = x + Y_i
+        w += 1e-8
+        np.reciprocal(w, out=w)
+        w *= w
+        wY = w * Y_i
+        distances[i, start:] = _cosine_from_dots(wY @ x, w @ (x * x), np.einsum('jk,jk->j', wY, Y_i))
+    return distances
+
+
+def _row_max_abs(X):
+    # max |x| of every row without an [n, d] np.abs(X) temporary
+    return np.maximum(X.max(axis=1, keepdims=True), -X.min(axis=1, keepdims=True))
+
+
+def _max_scaled(X):
+    # cosine/correlation don't depend on the scale of the rows, scaling them to max 1 avoids overflowing float32 dot products
+    scale = _row_max_abs(X)
+    return X / np.where(scale > 0, scale, 1)
+
+
+def _cosine_rows(X, inplace=False):
+    if inplace:
+        scale = _row_max_abs(X)
+        X /= np.where(scale > 0, scale, 1)
+    else:
+        X = _max_scaled(X)
+    return X, np.einsum('ik,ik->i', X, X)
+
+
+def _correlation_rows(X):
+    return _cosine_rows(X - X.mean(axis=1, keepdims=True), inplace=True)
+
+
+@_register_pairwise_distance('normalized_cosine', lambda e: get_variance(e, normalized=True), num_temporaries=1, prepare_fn=_cosine_rows)
+@_register_pairwise_distance('hessian_cosine', get_hessian, num_temporaries=1, prepare_fn=_cosine_rows)
+@_register_pairwise_distance('sketch_cosine', get_sketch, num_temporaries=1, prepare_fn=_cosine_rows)
+@_register_pairwise_distance('correlation', get_variance, num_temporaries=2, prepare_fn=_correlation_rows)
+def _cosine_rows_kernel(X, Y, starts=None):
+    # X, Y: (max scaled rows, their squared norms) from _cosine_rows/_correlation_rows
+    (X, xx), (Y, yy) = X, Y
+    return _cosine_from_dots(X @ Y.T, xx[:, None], yy[None, :])
+
+
+def _log_rows(X):
+    # (X, log X, 1 / X), so the kl kernels don't take a log (or divide) per pair
+    return X, np.log(X), np.reciprocal(X)
+
+
+@_register_pairwise_distance('kl', get_variance, num_temporaries=5, prepare_fn=_log_rows)
+def _kl_kernel(X, Y, starts):
+    # with r = var0 / var1: kl0 = .5 * (r - 1 - log r), kl1 = .5 * (1 / r - 1 + log r)
+    (X, log_X, inv_X), (Y, log_Y, inv_Y) = X, Y
+    distances = np.zeros([len(X), len(Y)])
+    for i, start in enumerate(starts):
+        log_r = log_X[i] - log_Y[start:]
+        kl0 = X[i] * inv_Y[start:]
+        kl0 -= log_r
+        kl1 = Y[start:] * inv_X[i]
+        kl1 += log_r
+        np.maximum(kl0, kl1, out=kl0)
+        kl0 -= 1
+        distances[i, start:] = .5 * kl0.sum(axis=1)
+    # (float32 rounding can make the kl of an embedding with itself slightly negative)
+    return np.maximum(distances, 0, out=distances)
+
+
+@_register_pairwise_distance('asymmetric_kl', get_variance, num_temporaries=3, prepare_fn=_log_rows)
+def _asymmetric_kl_kernel(X, Y, starts):
+    (X, log_X, _), (Y, log_Y, inv_Y) = X, Y
+    distances = np.zeros([len(X), len(Y)])
+    for i, start in enumerate(starts):
+        kl0 = X[i] * inv_Y[start:]
+        kl0 += log_Y[start:]
+        kl0 -= 1 + log_X[i]
+        distances[i, start:] = .5 * kl0.sum(axis=1)
+    return np.maximum(distances, 0, out=distances)
+
+
+def _mean_log_rows(X):
+    return X, np.log(X).mean(axis=1)
+
+
+@_register_pairwise_distance('jsd', get_variance, num_temporaries=2, prepare_fn=_mean_log_rows)
+def _jsd_kernel(X, Y, starts):
+    # var0 / var + var1 / var = 2 for var = (var0 + var1) / 2, so only the log terms of the two kls are left
+    (X, mean_log_X), (Y, mean_log_Y) = X, Y
+    distances = np.zeros([len(X), len(Y)])
+    for i, start in enumerate(starts):
+        distances[i, start:] = .5 * np.log(.5 * (X[i] + Y[start:])).mean(axis=1) - .25 * mean_log_X[i] - .25 * mean_log_Y[start:]
+    return distances
+
+
+def _entropy_rows(X):
+    # (X, log X, log(X + 1e-8)), zeros of X get a finite log since they're only multiplied by p = 0
+    return X, np.log(np.maximum(X, np.finfo(X.dtype).tiny)), np.log(X + 1e-8)
+
+
+@_register_pairwise_distance('entropy', get_hessian, num_temporaries=5, prepare_fn=_entropy_rows)
+def _entropy_kernel(X, Y, starts):
+    # binary entropy of p = x / s, s = x + y + 1e-8 (so 1 - p = (y + 1e-8) / s) without xlogy(p, p) + xlogy(1 - p, 1 - p):
+    # H(p) = log s - p log x - (1 - p) log(y + 1e-8) = log s - log(y + 1e-8) - p (log x - log(y + 1e-8)), one log per pair
+    (X, log_X, _), (Y, _, log_Y_eps) = X, Y
+    distances = np.zeros([len(X), len(Y)])
+    for i, start in enumerate(starts):
+        s = Y[start:] + X[i]
+        s += 1e-8
+        p = np.divide(X[i], s)
+        np.log(s, out=s)
+        s -= log_Y_eps[start:]
+        log_ratio = log_X[i] - log_Y_eps[start:]
+        log_ratio *= p
+        s -= log_ratio
+        distances[i, start:] = np.log(2) - s.mean(axis=1)
+    return distances
+
+
+def _stack_features(embeddings, distance) -> np.ndarray:
+    features_fn = _PAIRWISE_DISTANCES[distance][0]
+    return np.stack([features_fn(e) for e in embeddings]) if len(embeddings) > 0 else np.zeros([0, 0])
+
+
+def _pairwise_distances(X: np.ndarray, Y: np.ndarray, distance='cosine', memory_budget=MEMORY_BUDGET, condensed=False) -> np.ndarray:
+    """
+    [len(X), len(Y)] distance matrix between the rows of X and Y. Y is processed in blocks of rows whose temporaries fit
+    in memory_budget bytes. With condensed (pdist, X is Y) only the pairs i < j are compared and returned in condensed
+    form (the upper triangle row by row, like scipy's squareform), so no [n, n] matrix is allocated.
+    """
+    _, kernel, num_temporaries, prepare = _PAIRWISE_DISTANCES[distance]
+    n1, n2 = len(X), len(Y)
+    distances = np.zeros(n1 * (n1 - 1) // 2) if condensed else np.zeros([n1, n2])
+    if n1 == 0 or n2 == 0:
+        return distances
+    # - prepare X once (not once per block), Y is prepared a block at a time (or sliced from X if it's X)
+    prepared_X = prepare(X)
+    same = condensed or Y is X
+    block_size = max(1, memory_budget // (num_temporaries * Y.itemsize * Y.shape[1]))
+    for j in range(0, n2, block_size):
+        end = min(n2, j + block_size)
+        Y_block = _take_rows(prepared_X, j, end) if same else prepare(Y[j:end])
+        if not condensed:
+            distances[:, j:end] = kernel(prepared_X, Y_block, [0] * n1)
+            continue
+        num_rows = min(n1, end - 1)  # rows i < column j' for some j' in the block
+        if num_rows <= 0:
+            continue
+        starts = [max(0, i + 1 - j) for i in range(num_rows)]
+        block = kernel(_take_rows(prepared_X, 0, num_rows), Y_block, starts)
+        for i, start in enumerate(starts):
+            # pair (i, j') is at n * i - i * (i + 1) / 2 + j' - i - 1 of the condensed form
+            offset = n1 * i - i * (i + 1) // 2 - i - 1
+            distances[offset + j + start:offset + end] = block[i, start:]
+    return distances
+
+
+@traced('pdist')
+def pdist(embeddings, distance='cosine', memory_budget=MEMORY_BUDGET, condensed=False) -> np.ndarray:
+    """
+    Symmetric [n, n] distance matrix with zero diagonal (for asymmetric_kl the full [n, n] matrix). With condensed the
+    n * (n - 1) / 2 distances of the pairs i < j are returned instead (like scipy's pdist), half the memory and no
+    [n, n] matrix, stats_of_distance_matrix accepts both.
+    """
+    current_stage().add(examples=len(embeddings))
+    features = _stack_features(embeddings, distance)
     if distance != 'asymmetric_kl':
-        for (i, e1), (j, e2) in itertools.combinations(enumerate(embeddings), 2):
-            distance_matrix[i, j] = distance_fn(e1, e2)
-            distance_matrix[j, i] = distance_matrix[i, j]
+        distances = _pairwise_distances(features, features, distance, memory_budget, condensed=True)
+        return distances if condensed else squareform(distances)
+    elif condensed:
+        raise ValueError(f'Condensed form needs a symmetric distance, got {distance=}')
     else:
-        for (i, e1) in enumerate(embeddings):
-            for (j, e2) in enumerate(embeddings):
-                distance_matrix[i, j] = distance_fn(e1, e2)
-    return distance_matrix
+        return _pairwise_distances(features, features, distance, memory_budget)
 
 
-def cross_pdist(embeddings1, embeddings2, distance='cosine') -> np.ndarray :
+@traced('cross_pdist')
+def cross_pdist(embeddings1, embeddings2, distance='cosine', memory_budget=MEMORY_BUDGET) -> np.ndarray :
     """
     Compute pairwise distance between embeddings1 and embeddings2.
 
     ref: https://chat.openai.com/share/a5ca38dc-3393-4cfd-971c-4a29b0c56b63 
     """
-    distance_fn = _DISTANCES[distance]
-    n1 = len(embeddings1)
-    n2 = len(embeddings2)
-    distance_matrix = np.zeros([n1, n2])
-    if distance != 'asymmetric_kl':
-        for i, e1 in enumerate(embeddings1):
-            for j, e2 in enumerate(embeddings2):
-                distance_matrix[i, j] = distance_fn(e1, e2)
-    else:
-        for i, e1 in enumerate(embeddings1):
-            for j, e2 in enumerate(embeddings2):
-                distance_matrix[i, j] = distance_fn(e1, e2)
-    return distance_matrix
+    return _pairwise_distances(_stack_features(embeddings1, distance), _stack_features(embeddings2, distance), distance, memory_budget)
 
 
-def cdist(from_embeddings, to_embeddings, distance='cosine'):
-    distance_fn = _DISTANCES[distance]
+def cdist(from_embeddings, to_embeddings, distance='cosine', memory_budget=MEMORY_BUDGET):
+    """ Like cross_pdist, but embeddings can be None (their distances are left at 0). """
     distance_matrix = np.zeros([len(from_embeddings), len(to_embeddings)])
-    for (i, e1) in enumerate(from_embeddings):
-        for (j, e2) in enumerate(to_embeddings):
-            if e1 is None or e2 is None:
-                continue
-            distance_matrix[i, j] = distance_fn(e1, e2)
+    from_valid = [i for i, e in enumerate(from_embeddings) if e is not None]
+    to_valid = [j for j, e in enumerate(to_embeddings) if e is not None]
+    distances = cross_pdist([from_embeddings[i] for i in from_valid], [to_embeddings[j] for j in to_valid], distance, memory_budget)
+    distance_matrix[np.ix_(from_valid, to_valid)] = distances
     return distance_matrix
 
 
+## LLM DIV
+def paired_distances(embeddings1, embeddings2, rows, cols, distance='cosine', memory_budget=MEMORY_BUDGET) -> np.ndarray:
+    """
+    Distances of the pairs (embeddings1[rows[m]], embeddings2[cols[m]]), O(len(rows) * d). Pairs are grouped by row and
+    only the features of the embeddings of a block of pairs are stacked, i.e., not all the embeddings.
+    """
+    features_fn, kernel, num_temporaries, prepare = _PAIRWISE_DISTANCES[distance]
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    distances = np.zeros(len(rows))
+    order = np.argsort(rows, kind='stable')
+    starts = np.flatnonzero(np.r_[True, rows[order][1:] != rows[order][:-1]]) if len(rows) > 0 else []
+    for start, end in zip(starts, list(starts[1:]) + [len(rows)]):
+        x = features_fn(embeddings1[rows[order[start]]])[None]
+        prepared_x = prepare(x)
+        block_size = max(1, memory_budget // ((num_temporaries + 1) * x.itemsize * x.shape[1]))
+        for block_start in range(start, end, block_size):
+            pairs = order[block_start:min(end, block_start + block_size)]
+            Y = np.stack([features_fn(embeddings2[j]) for j in cols[pairs]])
+            distances[pairs] = kernel(prepared_x, prepare(Y), [0])[0]
+    return distances
+
+
 def plot_distance_matrix(embeddings, labels=None, distance='cosine', show_plot=True):
     import seaborn as sns
     from scipy.cluster.hierarchy import linkage
@@ -344,44 +570,78 @@ def plot_multi_distance_matrix_from_distance_matrix_list(distance_matrix_lst, ti
         plt.show()
 
 ## LLM DIV       
+## LLM DIV
+def condensed_distances(distance_matrix: np.ndarray) -> np.ndarray:
+    """ Distances of the pairs i < j of a symmetric [n, n] distance matrix (already condensed ones are returned as is). """
+    if distance_matrix.ndim == 1:
+        return distance_matrix
+    return squareform(distance_matrix, checks=False)
+
+
+def bootstrap_confidence_interval(values: np.ndarray,
+                                  confidence: float = 0.95,
+                                  num_bootstrap: int = 1000,
+                                  seed: int = 0,
+                                  chunk_size: int = 2 ** 22,
+                                  ) -> Tuple[float, float]:
+    """
+    Percentile bootstrap confidence interval (low, high) of the mean of values. Resamples are drawn chunk_size indices
+    at a time, so memory is bounded but the cost is num_bootstrap * len(values) draws.
+    """
+    rng = np.random.default_rng(seed)
+    num_values = len(values)
+    means = np.zeros(num_bootstrap)
+    if num_values <= chunk_size:
+        # several resamples per chunk
+        rows = max(1, chunk_size // num_values)
+        for b in range(0, num_bootstrap, rows):
+            num_rows = min(rows, num_bootstrap - b)
+            means[b:b + num_rows] = values[rng.integers(0, num_values, size=(num_rows, num_values))].mean(axis=1)
+    else:
+        for b in range(num_bootstrap):
+            total = 0.0
+            for start in range(0, num_values, chunk_size):
+                total += values[rng.integers(0, num_values, size=min(chunk_size, num_values - start))].sum()
+            means[b] = total / num_values
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
 def stats_of_distance_matrix(distance_matrix: np.ndarray,
                              remove_diagonal: bool = True,
-                             variance_type: str = 'std',    # TODO: was ci_0.95. Changed to rid uutils call
+                             variance_type: str = 'std',    # 'std' or e.g. 'ci_0.95' (half width of a bootstrap ci of the mean)
                              get_total: bool = False,
+                             num_bootstrap: int = 1000,
+                             seed: int = 0,
                              ) -> Tuple[float, float]:
-    if remove_diagonal:
-        # - remove diagonal: ref https://stackoverflow.com/questions/46736258/deleting-diagonal-elements-of-a-numpy-array
-        triu: np.ndarray = np.triu(distance_matrix)
-        tril: np.ndarray = np.tril(distance_matrix)
-        # distance_matrix = distance_matrix[~np.eye(distance_matrix.shape[0], dtype=bool)].reshape(distance_matrix.shape[0], -1)
-        # remove diagonal and dummy zeros where the other triangular matrix was artificially placed.
-        distance_matrix = triu[triu != 0.0]
-
-    # - flatten
-    distance_matrix: np.ndarray = distance_matrix.flatten()
-
-    # - compute stats of distance matrix
+    """
+    Mean and std (or ci) of the distances of a distance matrix, either [n, n] or in condensed form (see pdist).
+
+    With remove_diagonal (symmetric matrices, e.g., from pdist) only the pairs i < j are used, i.e., the condensed form,
+    including genuine zero distances. Without it, or for a rectangular matrix (e.g., a cross distance matrix, which has
+    no diagonal of self distances) all entries are used. Neither copies the [n, n] matrix.
+    """
+    # - distances of the pairs (condensed form is the upper triangle without the diagonal)
+    is_square: bool = distance_matrix.ndim == 2 and distance_matrix.shape[0] == distance_matrix.shape[1]
+    if distance_matrix.ndim == 1 or (remove_diagonal and is_square):
+        distances: np.ndarray = condensed_distances(distance_matrix)
+    else:
+        distances: np.ndarray = distance_matrix.reshape(-1)
+
+    # - compute stats of distances
+    mu = distances.mean()
     if variance_type == 'std':
-        mu, var = distance_matrix.mean(), distance_matrix.std()
-    # elif variance_type == 'ci_0.95':
-    #     from uutils.torch_uu.metrics.confidence_intervals import mean_confidence_interval
-    #     mu, var = mean_confidence_interval(distance_matrix, confidence=0.95)
+        var = distances.std()
+    elif variance_type.startswith('ci_'):
+        low, high = bootstrap_confidence_interval(distances, confidence=float(variance_type[len('ci_'):]),
+                                                  num_bootstrap=num_bootstrap, seed=seed)
+        var = (high - low) / 2
     else:
         raise ValueError(f'Invalid variance type, got: {variance_type=}')
 
-    # - double checks the mean was computed corrects. Since it's symmetric the mean after removing diagonal should be equal to just one side of the diagonals
-    if remove_diagonal:
-        # from uutils.torch_uu import approx_equal
-        # assert approx_equal(triu.sum(), tril.sum(), tolerance=1e-4), f'Distance matrix is not symmetric, are you sure this is correct?'
-        # assert approx_equal(distance_matrix.mean(), triu[triu != 0.0].mean(), tolerance=1e-4), f'Mean should be equal to triangular matrix'
-        # assert approx_equal(mu, triu[triu != 0.0].mean(), tolerance=1e-4)
-
-        print('Lower tri sum', tril.sum(), ' / Upper tri sum', triu.sum(), '| These should be approx equal!!')
-        print('Total mean', distance_matrix.mean(), ' / Upper mean', triu[triu != 0.0].mean(), ' / Lower mean', tril[tril != 0.0].mean(), '| These should all be approx equal!!')
-        print('mu (div coefficient)', mu, ' / Upper mean', triu[triu != 0.0].mean(), '| These should all be approx equal!!')
-
     if get_total:
-        total = distance_matrix.sum()
+        total = distances.sum()
         return mu, var, total
     else:
         return mu, var
@@ -389,17 +649,200 @@ def stats_of_distance_matrix(distance_matrix: np.ndarray,
 
 def stats_cross_distance_matrix(distance_matrix: np.ndarray,
                                 remove_diagonal: bool = False,
-                                variance_type: str = 'std',     # TODO: was ci_0.95. Changed to rid uutils call
+                                variance_type: str = 'std',     # 'std' or e.g. 'ci_0.95'
                                 get_total: bool = False,
+                                num_bootstrap: int = 1000,
+                                seed: int = 0,
                                 ) -> Tuple[float, float]:
-    return stats_of_distance_matrix(distance_matrix, remove_diagonal=remove_diagonal, variance_type=variance_type, get_total=get_total)
+    return stats_of_distance_matrix(distance_matrix, remove_diagonal=remove_diagonal, variance_type=variance_type,
+                                    get_total=get_total, num_bootstrap=num_bootstrap, seed=seed)
+
+
+## LLM DIV
+class OnlineDistanceStats:
+    """
+    Running stats of the pairwise distances of embeddings that arrive one at a time, e.g., the diversity coefficient
+    while batches are still being embedded. add(embedding) computes its k - 1 distances to the embeddings so far and
+    updates the mean/std of all pairs (Chan's parallel update) and the row sums of every embedding.
+
+    The mean over pairs is a U-statistic (pairs sharing an embedding are correlated), so its ci comes from the jackknife
+    over embeddings (leave one embedding and its k - 1 distances out), which only needs the row sums: O(k) per add.
+    """
+
+    def __init__(self, distance='cosine', confidence: float = 0.95, memory_budget=MEMORY_BUDGET):
+        from scipy.stats import norm
+        if distance == 'asymmetric_kl':
+            raise ValueError(f'Online stats need a symmetric distance, got {distance=}')
+        self.distance = distance
+        self.z = norm.ppf(.5 + confidence / 2)
+        self.memory_budget = memory_budget
+        self.embeddings = []
+        self.distances = []  # distances[k] = distances of embedding k to embeddings 0..k-1
+        self.row_sums = np.zeros(0)
+        self.num_pairs, self.mean, self.m2 = 0, 0.0, 0.0
+
+    def add(self, embedding) -> np.ndarray:
+        new_distances = cross_pdist([embedding], self.embeddings, self.distance, self.memory_budget)[0] if self.embeddings else np.zeros(0)
+        self.embeddings.append(embedding)
+        self.distances.append(new_distances)
+        self.row_sums[:len(new_distances)] += new_distances
+        self.row_sums = np.append(self.row_sums, new_distances.sum())
+        if len(new_distances) > 0:
+            num_pairs = self.num_pairs + len(new_distances)
+            delta = new_distances.mean() - self.mean
+            self.m2 += ((new_distances - new_distances.mean()) ** 2).sum() + delta ** 2 * self.num_pairs * len(new_distances) / num_pairs
+            self.mean += delta * len(new_distances) / num_pairs
+            self.num_pairs = num_pairs
+        return new_distances
+
+    def __len__(self) -> int:
+        return len(self.embeddings)
+
+    @property
+    def std(self) -> float:
+        return float(np.sqrt(self.m2 / self.num_pairs)) if self.num_pairs > 0 else float('nan')
+
+    @property
+    def ci(self) -> float:
+        """ Half width of the (normal, jackknife) ci of the mean distance, inf until there are 3 embeddings. """
+        k = len(self.embeddings)
+        if k < 3:
+            return float('inf')
+        total = self.mean * self.num_pairs
+        leave_one_out_means = (total - self.row_sums) / (self.num_pairs - (k - 1))
+        jackknife_var = (k - 1) / k * ((leave_one_out_means - leave_one_out_means.mean()) ** 2).sum()
+        return float(self.z * np.sqrt(jackknife_var))
+
+    def distance_matrix(self, condensed=False) -> np.ndarray:
+        """ [k, k] distance matrix of the embeddings so far (like pdist). """
+        distance_matrix = np.zeros([len(self.distances)] * 2)
+        for k, new_distances in enumerate(self.distances):
+            distance_matrix[k, :k] = new_distances
+        distance_matrix = distance_matrix + distance_matrix.T
+        return squareform(distance_matrix, checks=False) if condensed else distance_matrix
+
+
+## LLM DIV
+# fewest blocks the balanced design samples (unless it uses them all): its ci is a t-interval over the block totals,
+# which undercovers with few blocks when they are skewed (e.g., the shift 0 block of two overlapping sets)
+MIN_BALANCED_BLOCKS = 30
+
+
+def sample_pairs(n1: int, n2: int = None, num_pairs: int = 10_000, design: str = 'random', seed: int = 0,
+                 min_blocks: int = MIN_BALANCED_BLOCKS):
+    """
+    Pairs (rows, cols, blocks, num_blocks) to estimate the mean distance from, of the pairs i < j of n1 embeddings (n2
+    None, e.g., the div coeff) or of all n1 x n2 pairs of two sets (e.g., the cross div coeff).
+
+    design='random': num_pairs pairs drawn uniformly with replacement (blocks are single pairs, num_blocks is None).
+    design='balanced': the pairs are partitioned into blocks of equal size by the cyclic shift (j - i) mod n, i.e.,
+    (i, (i + s) mod n) for every i, and about num_pairs / n1 of the blocks are drawn without replacement, so every
+    embedding is used (almost) equally often. For the pairs i < j of an even n the n / 2 pairs of shift n / 2 are half a
+    block, they are always used (block -1) instead. If that's fewer than min_blocks blocks (and not all of them) the
+    random design is used instead.
+    """
+    rng = np.random.default_rng(seed)
+    if design == 'balanced':
+        num_shifts = (n1 - 1) // 2 if n2 is None else n2
+        if min(num_shifts, max(2, round(num_pairs / n1))) < min(min_blocks, num_shifts):
+            print(f'Using the random design: the balanced one would only sample {round(num_pairs / n1)} blocks < {min_blocks=}')
+            design = 'random'
+    if design == 'random':
+        if n2 is None:
+            # uniform i != j, i.e., uniform over the pairs i < j once sorted
+            rows = rng.integers(0, n1, size=num_pairs)
+            cols = rng.integers(0, n1 - 1, size=num_pairs)
+            cols = cols + (cols >= rows)
+            rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        else:
+            rows, cols = rng.integers(0, n1, size=num_pairs), rng.integers(0, n2, size=num_pairs)
+        return rows, cols, np.arange(num_pairs), None
+    elif design == 'balanced':
+        # shifts 1..(n - 1) // 2 (+ n / 2 for even n) cover every pair i < j once, shifts 0..n2 - 1 every pair of n1 x n2
+        n = n1 if n2 is None else n2
+        shifts = np.arange(1, (n1 - 1) // 2 + 1) if n2 is None else np.arange(n2)
+        num_blocks = min(len(shifts), max(2, round(num_pairs / n1)))
+        sampled = [(block, shift, np.arange(n1)) for block, shift in enumerate(rng.choice(shifts, size=num_blocks, replace=False))]
+        if n2 is None and n1 % 2 == 0:
+            sampled.append((-1, n1 // 2, np.arange(n1 // 2)))
+        rows = np.concatenate([block_rows for _, _, block_rows in sampled]).astype(int)
+        cols = np.concatenate([(block_rows + shift) % n for _, shift, block_rows in sampled]).astype(int)
+        blocks = np.concatenate([np.full(len(block_rows), block) for block, _, block_rows in sampled]).astype(int)
+        if n2 is None:
+            rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+        return rows, cols, blocks, len(shifts)
+    else:
+        raise ValueError(f'Invalid design, got: {design=}')
+
+
+def estimate_mean_distance(embeddings1,
+                           embeddings2=None,
+                           num_pairs: int = 10_000,
+                           design: str = 'random',
+                           distance='cosine',
+                           seed: int = 0,
+                           confidence: float = 0.95,
+                           memory_budget=MEMORY_BUDGET,
+                           ) -> dict:
+    """
+    Estimate of the mean pairwise distance of embeddings1 (i.e., the div coeff, mean over the pairs i < j) or between
+    embeddings1 and embeddings2 (the cross div coeff) from a subsample of the pairs (see sample_pairs), O(num_pairs * d)
+    instead of O(n^2 * d) for pdist.
+
+    The estimate is unbiased for the mean over all pairs of these embeddings and so is its variance estimate (variance
+    of the estimate over the sampled pairs, for the balanced design the between block variance with the finite
+    population correction). The balanced design has less variance when the distances of an embedding are correlated,
+    but its t-interval needs enough blocks: with fewer than MIN_BALANCED_BLOCKS (num_pairs / n1) the random design is
+    used. Returns {'mean', 'variance', 'ci' (ci half width, normal or t for the blocks), 'num_pairs', 'design' (used)}.
+    """
+    from scipy.stats import norm, t
+    if distance == 'asymmetric_kl' and embeddings2 is None:
+        raise ValueError(f'Estimating the mean over the pairs i < j needs a symmetric distance, got {distance=}')
+    n1, n2 = len(embeddings1), None if embeddings2 is None else len(embeddings2)
+    rows, cols, blocks, num_blocks = sample_pairs(n1, n2, num_pairs, design=design, seed=seed)
+    distances = paired_distances(embeddings1, embeddings1 if embeddings2 is None else embeddings2, rows, cols, distance, memory_budget)
+    if num_blocks is None:  # random design (also when balanced has too few blocks, see sample_pairs)
+        design = 'random'
+        mean = distances.mean()
+        variance = distances.var(ddof=1) / len(distances)
+        quantile = norm.ppf(.5 + confidence / 2)
+    else:
+        # expansion estimate of the total from the block totals (blocks of equal size drawn without replacement out of
+        # num_blocks) plus the pairs that are always used
+        total_pairs = n1 * (n1 - 1) // 2 if n2 is None else n1 * n2
+        always_total = distances[blocks == -1].sum()
+        block_totals = np.bincount(blocks[blocks >= 0], weights=distances[blocks >= 0], minlength=0)
+        num_sampled = len(block_totals)
+        mean = (always_total + (num_blocks * block_totals.mean() if num_sampled > 0 else 0.0)) / total_pairs
+        if num_sampled < num_blocks:
+            variance = (num_blocks / total_pairs) ** 2 * (1 - num_sampled / num_blocks) * block_totals.var(ddof=1) / num_sampled
+        else:
+            variance = 0.0  # all pairs were used
+        # few blocks, so the variance estimate has few degrees of freedom
+        quantile = t.ppf(.5 + confidence / 2, df=max(1, num_sampled - 1))
+    ci = quantile * np.sqrt(variance)
+    return {'mean': float(mean), 'variance': float(variance), 'ci': float(ci), 'num_pairs': len(distances), 'design': design}
+
+
+## LLM DIV
+def sketch_distance_error(embeddings, num_pairs: int = 100, seed: int = 0, delta: float = 0.05) -> dict:
+    """
+    Error of sketch_cosine against the exact hessian_cosine on num_pairs random pairs of embeddings (which need both
+    their hessian and sketch), along with the JL bound for all pairs of the embeddings at once (see jl_error_bound).
+    """
+    from diversity.sketching import jl_error_bound
+    rows, cols, _, _ = sample_pairs(len(embeddings), None, num_pairs=num_pairs, design='random', seed=seed)
+    exact = paired_distances(embeddings, embeddings, rows, cols, 'hessian_cosine')
+    sketched = paired_distances(embeddings, embeddings, rows, cols, 'sketch_cosine')
+    errors = np.abs(sketched - exact)
+    dim = len(get_sketch(embeddings[0]))
+    return {'max_abs_error': float(errors.max()), 'mean_abs_error': float(errors.mean()), 'dim': dim,
+            'bound': jl_error_bound(dim, num_pairs=len(embeddings) * (len(embeddings) - 1) // 2, delta=delta)}
 
 
 def plot_histogram_of_distances(distance_matrix: np.ndarray, title, show_plot=True, save_file=None, bins_width=None, grid=True):
     import matplotlib.pyplot as plt
-    triu = np.triu(distance_matrix)
-    triu = triu[triu != 0.0]
-    distance_values = triu.flatten()
+    distance_values = condensed_distances(distance_matrix)
     
     if grid:
         plt.grid(zorder=0)
@@ -483,4 +926,102 @@ def plot_multi_histogram_of_distances(distance_matrix_lst, title_lst, main_title
     if save_file:
         _ = plt.savefig("plots/" + save_file + ".png", bbox_inches='tight')
     if show_plot:
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+# -- Tests, examples
+
+def test_pairwise_distances():
+    from diversity.task2vec import Embedding
+    rng = np.random.default_rng(0)
+    def embeddings(n):
+        return [Embedding(rng.gamma(0.5, size=300).astype(np.float32) + 0.1, sketch=rng.normal(size=16).astype(np.float32)) for _ in range(n)]
+    E1, E2 = embeddings(7), embeddings(4)
+    def close(a, b):
+        return np.allclose(a, b, rtol=1e-4, atol=1e-6)
+    for name, distance_fn in _DISTANCES.items():
+        if name not in _PAIRWISE_DISTANCES:
+            continue
+        # the kernels match the scalar distance of every pair, with blocks of one row and with the default budget
+        expected_cross = np.array([[distance_fn(e1, e2) for e2 in E2] for e1 in E1])
+        for memory_budget in (1, MEMORY_BUDGET):
+            assert close(cross_pdist(E1, E2, distance=name, memory_budget=memory_budget), expected_cross), f'Err: cross_pdist {name=}'
+            dm = pdist(E1, distance=name, memory_budget=memory_budget)
+            if name == 'asymmetric_kl':
+                assert close(dm, np.maximum([[distance_fn(e1, e2) for e2 in E1] for e1 in E1], 0)), f'Err: pdist {name=}'
+                continue
+            expected = np.array([distance_fn(E1[i], E1[j]) for i in range(len(E1)) for j in range(i + 1, len(E1))])
+            assert close(squareform(dm, checks=False), expected), f'Err: pdist {name=}'
+            assert close(pdist(E1, distance=name, memory_budget=memory_budget, condensed=True), expected), f'Err: condensed pdist {name=}'
+        # cdist leaves the distances of missing embeddings at 0, paired_distances are the entries of cross_pdist
+        dm = cdist([E1[0], None, E1[1]], [None] + E2, distance=name)
+        assert close(dm[[0, 2], 1:], expected_cross[:2]) and not dm[1].any() and not dm[:, 0].any(), f'Err: cdist {name=}'
+        rows, cols = rng.integers(len(E1), size=10), rng.integers(len(E2), size=10)
+        assert close(paired_distances(E1, E2, rows, cols, distance=name), expected_cross[rows, cols]), f'Err: paired_distances {name=}'
+    print('Success!')
+
+
+def test_online_distance_stats():
+    from diversity.task2vec import Embedding
+    rng = np.random.default_rng(0)
+    embeddings = [Embedding(rng.gamma(0.5, size=50).astype(np.float32) + 1e-3) for _ in range(60)]
+    stats, cis = OnlineDistanceStats(), []
+    for k, embedding in enumerate(embeddings, start=1):
+        stats.add(embedding)
+        cis.append(stats.ci)
+        if k >= 2:
+            # the incremental mean/std are the ones of the batch mode on the embeddings so far
+            mean, std = stats_of_distance_matrix(pdist(embeddings[:k]))
+            assert np.isclose(stats.mean, mean) and np.isclose(stats.std, std), f'Err: {k=} {stats.mean=} {mean=}'
+    assert np.allclose(stats.distance_matrix(), pdist(embeddings))
+    assert np.allclose(stats.distance_matrix(condensed=True), pdist(embeddings, condensed=True))
+    # the jackknife ci shrinks (about as 1 / sqrt(k)) as embeddings arrive, stopping at ci_target like the online div coeff
+    assert np.isinf(cis[1]) and cis[59] < cis[19] < cis[4], f'Err: ci does not shrink {cis[4]=} {cis[19]=} {cis[59]=}'
+    ci_target, min_batches = cis[29], 10
+    stats = OnlineDistanceStats()
+    for embedding in embeddings:
+        stats.add(embedding)
+        if len(stats) >= min_batches and stats.ci <= ci_target:
+            break
+    assert stats.ci <= ci_target and len(stats) == next(k for k, ci in enumerate(cis, start=1) if k >= min_batches and ci <= ci_target)
+    print('Success!')
+
+def test_estimate_mean_distance():
+    from diversity.task2vec import Embedding
+    rng = np.random.default_rng(0)
+    embeddings = [Embedding(rng.gamma(0.5, size=50).astype(np.float32) + 1e-3) for _ in range(80)]
+    distance_matrix = pdist(embeddings)
+    rows, cols, _, _ = sample_pairs(len(embeddings), num_pairs=100, seed=0)
+    assert np.allclose(paired_distances(embeddings, embeddings, rows, cols), distance_matrix[rows, cols])
+    # both designs are unbiased for the mean over all pairs i < j and their 95% ci covers it (about) 95% of the time
+    mean = condensed_distances(distance_matrix).mean()
+    for design in ('random', 'balanced'):
+        estimates = [estimate_mean_distance(embeddings, num_pairs=35 * len(embeddings), design=design, seed=seed) for seed in range(100)]
+        assert all(estimate['design'] == design for estimate in estimates)
+        errors = np.array([estimate['mean'] - mean for estimate in estimates])
+        coverage = np.mean([abs(error) <= estimate['ci'] for error, estimate in zip(errors, estimates)])
+        assert abs(errors.mean()) < 3 * errors.std() / 10 and coverage >= 0.88, f'Err: {design=} {coverage=} {errors.mean()=}'
+    # all the blocks are every pair: exact, too few blocks: random design
+    assert np.isclose(estimate_mean_distance(embeddings, num_pairs=10 ** 6, design='balanced')['mean'], mean)
+    assert estimate_mean_distance(embeddings, num_pairs=5 * len(embeddings), design='balanced')['design'] == 'random'
+    print('Success!')
+
+def test_stats_of_distance_matrix():
+    rng = np.random.default_rng(0)
+    condensed = rng.random(10 * 9 // 2)
+    # square (pdist) and condensed forms give the stats of the pairs i < j
+    for distance_matrix in (squareform(condensed), condensed):
+        mu, std = stats_of_distance_matrix(distance_matrix)
+        assert np.isclose(mu, condensed.mean()) and np.isclose(std, condensed.std())
+    # rectangular (e.g., cross distance matrices passed with the default remove_diagonal) use all the entries
+    cross = rng.random([4, 7])
+    for remove_diagonal in (True, False):
+        mu, std = stats_of_distance_matrix(cross, remove_diagonal=remove_diagonal)
+        assert np.isclose(mu, cross.mean()) and np.isclose(std, cross.std())
+    assert np.isclose(stats_cross_distance_matrix(cross)[0], cross.mean())
+    print('Success!')
+
+if __name__ == '__main__':
+    test_pairwise_distances()
+    test_online_distance_stats()
+    test_estimate_mean_distance()
+    test_stats_of_distance_matrix()
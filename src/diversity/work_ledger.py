@@ -0,0 +1,167 @@
+"""
+File based work ledger to split the tasks (batches) of a diversity run across hosts that share a file system.
+
+The num_items tasks are cut into shards of shard_size consecutive items. For shard k the ledger directory has
+    - shard_{k}.claim: created exclusively (O_EXCL) by the host that works on it, json {owner, claimed_at}. Its mtime is
+    the heartbeat, refreshed by a background thread while the host works on the shard,
+    - shard_{k}.done: written (atomically, via rename) once the shard's results are saved.
+A claim whose heartbeat is older than stale_after seconds belongs to a host that was killed/preempted and is taken over:
+the stale claim is renamed away first (rename is atomic, so only one host wins) and then claimed as usual. Since tasks
+are deterministic given their index, a shard done twice (e.g., a slow host that was presumed dead) writes the same
+results, and results are saved with an atomic rename so readers never see half a shard.
+
+ledger = WorkLedger(output_dir + '/ledger', num_items=600, shard_size=25)
+while (shard := ledger.claim()) is not None:
+    with ledger.heartbeat(shard):
+        for item in ledger.items(shard):
+            ...
+        save shard results
+    ledger.done(shard)
+"""
+import json
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Optional
+
+
+def default_owner() -> str:
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+def atomic_write_text(path, text: str):
+    """ Writes text to path via a temporary file and rename, so readers see either nothing or all of it. """
+    tmp = f'{path}.tmp-{uuid.uuid4().hex[:8]}'
+    with open(tmp, 'w') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class WorkLedger:
+
+    def __init__(self, path, num_items: int, shard_size: int, owner: str = None, stale_after: float = 600.0):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.num_items = num_items
+        self.shard_size = shard_size
+        self.num_shards = (num_items + shard_size - 1) // shard_size
+        self.owner = owner or default_owner()
+        self.stale_after = stale_after
+
+    def items(self, shard: int) -> range:
+        return range(shard * self.shard_size, min(self.num_items, (shard + 1) * self.shard_size))
+
+    def _claim_path(self, shard: int) -> Path:
+        return self.path / f'shard_{shard:05d}.claim'
+
+    def _done_path(self, shard: int) -> Path:
+        return self.path / f'shard_{shard:05d}.done'
+
+    def is_done(self, shard: int) -> bool:
+        return self._done_path(shard).exists()
+
+    def all_done(self) -> bool:
+        return all(self.is_done(shard) for shard in range(self.num_shards))
+
+    def _try_create_claim(self, shard: int) -> bool:
+        try:
+            fd = os.open(self._claim_path(shard), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(json.dumps({'owner': self.owner, 'claimed_at': time.time()}))
+        return True
+
+    def _is_stale(self, shard: int) -> bool:
+        try:
+            return time.time() - self._claim_path(shard).stat().st_mtime > self.stale_after
+        except FileNotFoundError:
+            return False  # released in the meantime, claim it the normal way next time
+
+    def owner_of(self, shard: int) -> Optional[str]:
+        try:
+            return json.loads(self._claim_path(shard).read_text())['owner']
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            return None
+
+    def claim(self) -> Optional[int]:
+        """ Claims the first shard that is neither done nor claimed by a live host, None if there is none left. """
+        for shard in range(self.num_shards):
+            if self.is_done(shard):
+                continue
+            if self._try_create_claim(shard):
+                return shard
+            if self._is_stale(shard):
+                # take over the shard of a preempted host: only the host whose rename succeeds may re-claim it
+                try:
+                    os.rename(self._claim_path(shard), self.path / f'shard_{shard:05d}.stale-{uuid.uuid4().hex[:8]}')
+                except FileNotFoundError:
+                    continue
+                print(f'Re-claiming stale {shard=}')
+                if self._try_create_claim(shard):
+                    return shard
+        return None
+
+    def touch(self, shard: int):
+        """ Refreshes the heartbeat of a claimed shard. """
+        try:
+            os.utime(self._claim_path(shard))
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def heartbeat(self, shard: int, interval: float = None):
+        """ Refreshes the claim of shard every interval seconds (default stale_after / 4) in a background thread. """
+        interval = self.stale_after / 4 if interval is None else interval
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.touch(shard)
+
+        thread = threading.Thread(target=beat, name=f'heartbeat-{shard}', daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def done(self, shard: int):
+        atomic_write_text(self._done_path(shard), json.dumps({'owner': self.owner, 'done_at': time.time()}))
+        if self.owner_of(shard) == self.owner:
+            self._claim_path(shard).unlink(missing_ok=True)
+
+    def release(self, shard: int):
+        """ Gives up a claim without finishing the shard (e.g., on an error), so another host can take it right away. """
+        if self.owner_of(shard) == self.owner:
+            self._claim_path(shard).unlink(missing_ok=True)
+
+# -- Tests, examples
+
+def test_work_ledger():
+    import tempfile
+    with tempfile.TemporaryDirectory() as tmp:
+        host_a, host_b, host_c = (WorkLedger(tmp, num_items=10, shard_size=4, owner=owner, stale_after=0.2) for owner in 'abc')
+        assert host_a.num_shards == 3 and list(host_a.items(2)) == [8, 9]
+        assert host_a.claim() == 0 and host_b.claim() == 1
+        host_b.done(1)
+        # a is preempted while working on shard 0: c takes over its stale claim but not b's live one on shard 2
+        assert host_b.claim() == 2
+        with host_b.heartbeat(2, interval=0.05):
+            time.sleep(0.4)
+            assert host_c.claim() == 0 and host_c.owner_of(0) == 'c'
+            assert host_c.claim() is None, 'Err: claim with a heartbeat was taken over'
+        host_b.done(2)
+        host_c.done(0)
+        assert host_a.all_done() and host_a.claim() is None
+    print('Success!')
+
+if __name__ == '__main__':
+    test_work_ledger()
@@ -11,7 +11,7 @@ from pathlib import Path
 import torch
 import torch.nn as nn
 
-from alignment.align import alignment_with_diversity_coefficient
+from alignment.align import alignment_with_diversity_coefficient, alignment_matrix
 
 from datasets import load_dataset, interleave_datasets
 from transformers import GPT2Tokenizer, GPT2LMHeadModel
@@ -33,47 +33,56 @@ def map_func(batch):
     return batch.map(preprocess, batched=True, remove_columns=remove_columns)
 
 
+def load_datasets() -> dict:
+    """ name -> function loading the (streaming) data set, so only the data sets that are used get loaded. """
+    def load(*args, **kwargs):
+        return lambda: load_dataset(*args, **kwargs).with_format('torch').to_iterable_dataset()
+    loaders = {"pubmedT": load('SudharsanSundar/PileSubsets', 'pubmed', split='train'),
+               "USPTOT": load('SudharsanSundar/PileSubsets', 'uspto', split='train'),
+               "comboT": lambda: interleave_datasets([loaders["pubmedT"](), loaders["USPTOT"]()], probabilities=[0.4568, 0.5431]),
+               "pile": load('monology/pile', split='train'),
+               "wikitext": load('wikitext', 'wikitext-103-v1', split='validation'),
+               "opensubs": load('suolyer/pile_opensubtitles', split='validation'),
+               "openwebtext2": load('suolyer/pile_openwebtext2', split='validation'),
+               "nihexporter": load('suolyer/pile_nih-exporter', split='validation'),
+               "hnews": load('suolyer/pile_hackernews', split='validation'),
+               "tinystories": load('roneneldan/TinyStories', split='validation'),
+               "pubmedV": load('suolyer/pile_pubmed-abstracts', split='validation'),
+               "usptoV": load('suolyer/pile_uspto', split='validation')}
+    return loaders
+
+
 def main():
+    """
+    python testing_cached.py 0 1 100   # alignment of data sets 0 and 1 (see names_list) with 100 batches
+    python testing_cached.py all 100   # alignment matrix of all the data sets, every data set is embedded once
+    """
+    loaders = load_datasets()
+    names_list = list(loaders)
+
+    probe_network = GPT2LMHeadModel.from_pretrained("gpt2")
+    device = torch.device(f"cuda:{0}" if torch.cuda.is_available() else "cpu")
+    probe_network = probe_network.to(device)
+
+    if len(sys.argv) > 1 and sys.argv[1] == 'all':
+        num_batches = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+        datasets = {name: loader() for name, loader in loaders.items()}
+        output = alignment_matrix(datasets, map_func, probe_network, batch_size=512, num_batches=num_batches, buffer_size=500000, shuffle=True)
+        print('\nnames', output['names'])
+        print('\ncross div coeff\n', output['cross_div_coeff'])
+        print('\ncross div coeff ci (really stdev)\n', output['cross_div_coeff_ci'])
+        print('\ncross_align\n', output['cross_align'])
+        return
+
     arg1 = int(sys.argv[1]) if len(sys.argv) > 1 else 0
     arg2 = int(sys.argv[2]) if len(sys.argv) > 2 else 1
     arg3 = int(sys.argv[3]) if len(sys.argv) > 3 else 100
 
-    pubmedT = load_dataset('SudharsanSundar/PileSubsets', 'pubmed', split='train').with_format('torch')
-    pubmedT = pubmedT.to_iterable_dataset()
-    USPTOT = load_dataset('SudharsanSundar/PileSubsets', 'uspto', split='train').with_format('torch')
-    USPTOT = USPTOT.to_iterable_dataset()
-    comboT = interleave_datasets([pubmedT, USPTOT], probabilities=[0.4568, 0.5431])
-    pile = load_dataset('monology/pile', split='train').with_format('torch')
-    pile = pile.to_iterable_dataset()
-    wikitext = load_dataset('wikitext', 'wikitext-103-v1', split='validation').with_format('torch')
-    wikitext = wikitext.to_iterable_dataset()
-    opensubs = load_dataset('suolyer/pile_opensubtitles', split='validation').with_format('torch')
-    opensubs = opensubs.to_iterable_dataset()
-    openwebtext2 = load_dataset('suolyer/pile_openwebtext2', split='validation').with_format('torch')
-    openwebtext2 = openwebtext2.to_iterable_dataset()
-    nihexporter = load_dataset('suolyer/pile_nih-exporter', split='validation').with_format('torch')
-    nihexporter = nihexporter.to_iterable_dataset()
-    hnews = load_dataset('suolyer/pile_hackernews', split='validation').with_format('torch')
-    hnews = hnews.to_iterable_dataset()
-    tinystories = load_dataset('roneneldan/TinyStories', split='validation').with_format('torch')
-    tinystories = tinystories.to_iterable_dataset()
-    pubmedV = load_dataset('suolyer/pile_pubmed-abstracts', split='validation').with_format('torch')
-    pubmedV = pubmedV.to_iterable_dataset()
-    usptoV = load_dataset('suolyer/pile_uspto', split='validation').with_format('torch')
-    usptoV = usptoV.to_iterable_dataset()
-
-    dataset_list = [pubmedT, USPTOT, comboT, pile, wikitext, opensubs, openwebtext2, nihexporter, hnews, tinystories, pubmedV, usptoV]
-    names_list = ["pubmedT", "USPTOT", "comboT", "pile", "wikitext", "opensubs", "openwebtext2", "nihexporter", "hnews", "tinystories", "pubmedV", "usptoV"]
-
-    dataset1 = dataset_list[arg1]
-    dataset2 = dataset_list[arg2]
+    dataset1 = loaders[names_list[arg1]]()
+    dataset2 = loaders[names_list[arg2]]()
 
     print('These are the arguments:', arg1, "/", arg2, '\nAnd these are the corresponding datasets:', names_list[arg1], "/", names_list[arg2])
 
-    probe_network = GPT2LMHeadModel.from_pretrained("gpt2")
-    device = torch.device(f"cuda:{0}" if torch.cuda.is_available() else "cpu")
-    probe_network = probe_network.to(device)
-
     output = alignment_with_diversity_coefficient(dataset1,
                                                   dataset2,
                                                   map_func,
@@ -20,6 +20,8 @@ from transformers import PreTrainedTokenizer, AutoTokenizer, AutoModelForCausalL
 from transformers.testing_utils import CaptureLogger
 from transformers import GPT2Tokenizer
 
+from diversity.batch_sampling import IndexSampler
+
 def cuda_debug():
     import torch
 
@@ -171,14 +173,15 @@ def get_data_from_hf_dataset(dataset,
                              streaming: bool = True, 
                              batch_size: int = 4, 
                             #  shuffle: bool= False, # shuffle is better but slower afaik
-                            #  seed: int = 0, 
+                             seed: Optional[int] = None,
                             #  buffer_size: int = 500_000,
                              ):
     """ Gets data from a HF dataset, it's usually an iterator object e.g., some ds.map(fn, batched=True, remove_columns=remove_columns) has been applied. 
     Handles both streaming and non-streaming datasets, take for streaming and select for non-streaming.
+    Non-streaming rows are sampled in O(batch_size) (see IndexSampler), with the global random state if seed is None.
     """
     # sample_data = dataset.select(range(batch_size)) if not isinstance(dataset, datasets.iterable_dataset.IterableDataset) else dataset.take(batch_size)
-    batch = dataset.take(batch_size) if streaming else dataset.select(random.sample(list(range(len(dataset))), batch_size))
+    batch = dataset.take(batch_size) if streaming else dataset.select(IndexSampler(len(dataset), seed=seed).sample(batch_size))
     return batch
 
 def _tokenize_function(examples, tokenizer, tok_logger, text_column_name: str):